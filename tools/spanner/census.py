@@ -0,0 +1,206 @@
+# Storage census of the spanner database
+#
+# Gathers, in one parallel pass over fxa_uid ranges:
+# - the number of bsos and their total payload bytes, per collection
+# - the number of distinct users, and of users active in the last
+#   `--active_days` days (from user_collections.modified)
+# - the number of pending (not yet expired) batches
+#
+# Every range is read with a snapshot at the same stale timestamp, so
+# the census is consistent and takes no locks. Spanner only keeps old
+# versions for an hour by default, so ranges started more than
+# `--max_read_age` seconds after that timestamp (or refused with
+# FailedPrecondition) are read at their own stale timestamp instead, and
+# the report is marked as not consistent. The results are published as
+# `syncstorage.census.*` gauges and written as a JSON report.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import argparse
+import json
+import logging
+import sys
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta
+
+from statsd.defaults.env import statsd
+
+from google.api_core.exceptions import FailedPrecondition
+from google.cloud.spanner_v1 import param_types
+
+from count_users import client, from_env
+from key_ranges import key_ranges, range_conditions, range_name
+
+
+def census_range(database, key_range, active_since, **snapshot_args):
+    """all of the census counts for one range"""
+    (conditions, params, types) = range_conditions(key_range)
+    result = {
+        "bsos": Counter(),
+        "payload_bytes": Counter(),
+    }
+    with database.snapshot(multi_use=True, **snapshot_args) as snapshot:
+        rows = snapshot.execute_sql(
+            "SELECT collection_id, COUNT(*), "
+            "COALESCE(SUM(BYTE_LENGTH(payload)), 0) "
+            "FROM bsos WHERE {} GROUP BY collection_id".format(conditions),
+            params=params, param_types=types)
+        for (collection_id, count, size) in rows:
+            result["bsos"][collection_id] += count
+            result["payload_bytes"][collection_id] += size
+
+        user_params = dict(params, since=active_since)
+        user_types = dict(types, since=param_types.TIMESTAMP)
+        (users, active) = snapshot.execute_sql(
+            "SELECT COUNT(DISTINCT fxa_uid), "
+            "COUNT(DISTINCT IF(modified >= @since, fxa_uid, NULL)) "
+            "FROM user_collections WHERE {}".format(conditions),
+            params=user_params, param_types=user_types).one()
+        result["users"] = users
+        result["active_users"] = active
+
+        result["pending_batches"] = snapshot.execute_sql(
+            "SELECT COUNT(*) FROM batches WHERE {} "
+            "AND expiry >= CURRENT_TIMESTAMP()".format(conditions),
+            params=params, param_types=types).one()[0]
+    return result
+
+
+def read_range(database, key_range, read_timestamp, active_since, args):
+    """census one range at the shared read timestamp, while that can
+    still be read, or else at its own. returns (result, shared)"""
+    age = (datetime.utcnow() - read_timestamp).total_seconds()
+    if age < args.max_read_age:
+        try:
+            return (census_range(database, key_range, active_since,
+                                 read_timestamp=read_timestamp), True)
+        except FailedPrecondition as ex:
+            logging.warning("Reading {} at its own timestamp: {}".format(
+                range_name(key_range), ex))
+    return (census_range(database, key_range, active_since,
+                         exact_staleness=timedelta(seconds=args.staleness)),
+            False)
+
+
+def collection_names(database, read_timestamp):
+    with database.snapshot(read_timestamp=read_timestamp) as snapshot:
+        return dict(snapshot.execute_sql(
+            "SELECT collection_id, name FROM collections"))
+
+
+def take_census(database, args):
+    """run every range, returns the combined report"""
+    read_timestamp = datetime.utcnow() - timedelta(seconds=args.staleness)
+    active_since = read_timestamp - timedelta(days=args.active_days)
+    names = collection_names(database, read_timestamp)
+    totals = {
+        "bsos": Counter(),
+        "payload_bytes": Counter(),
+        "users": 0,
+        "active_users": 0,
+        "pending_batches": 0,
+    }
+    late = 0
+    with ThreadPoolExecutor(max_workers=args.parallelism) as pool:
+        futures = dict(
+            (pool.submit(read_range, database, key_range, read_timestamp,
+                         active_since, args), key_range)
+            for key_range in key_ranges(args.ranges))
+        for future in as_completed(futures):
+            (result, shared) = future.result()
+            late += not shared
+            logging.debug("Counted {}".format(range_name(futures[future])))
+            for (key, value) in result.items():
+                totals[key] += value
+
+    if late:
+        logging.warning(
+            "{} ranges were read after {}, the census is not consistent"
+            .format(late, read_timestamp.isoformat() + "Z"))
+    return {
+        "read_timestamp": read_timestamp.isoformat() + "Z",
+        "consistent": not late,
+        "late_ranges": late,
+        "active_days": args.active_days,
+        "users": totals["users"],
+        "active_users": totals["active_users"],
+        "pending_batches": totals["pending_batches"],
+        "bsos": sum(totals["bsos"].values()),
+        "payload_bytes": sum(totals["payload_bytes"].values()),
+        "collections": dict(
+            (names.get(collection_id, str(collection_id)), {
+                "bsos": totals["bsos"][collection_id],
+                "payload_bytes": totals["payload_bytes"][collection_id],
+            })
+            for collection_id in sorted(totals["bsos"])),
+    }
+
+
+def publish(report):
+    for key in ("users", "active_users", "pending_batches", "bsos",
+                "payload_bytes"):
+        statsd.gauge("syncstorage.census.{}".format(key), report[key])
+    for (name, counts) in report["collections"].items():
+        for (key, value) in counts.items():
+            statsd.gauge(
+                "syncstorage.census.{}.{}".format(key, name), value)
+
+
+def spanner_read_data(request=None, args=None):
+    args = args or get_args([])
+    (instance_id, database_id) = from_env()
+    instance = client.instance(instance_id)
+    database = instance.database(database_id)
+
+    logging.info("For {}:{}".format(instance_id, database_id))
+
+    with statsd.timer("syncstorage.census.duration"):
+        report = take_census(database, args)
+    publish(report)
+    logging.info("Census found {} users ({} active), {} bsos".format(
+        report["users"], report["active_users"], report["bsos"]))
+    if args.report == "-":
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+    else:
+        with open(args.report, "w") as report_file:
+            json.dump(report, report_file, indent=2)
+    return report
+
+
+def get_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Count users, bsos, payload bytes and pending batches")
+    parser.add_argument(
+        '--ranges', type=int, default=64,
+        help="number of fxa_uid ranges to split the work into")
+    parser.add_argument(
+        '--parallelism', type=int, default=8,
+        help="maximum number of ranges read at once")
+    parser.add_argument(
+        '--active_days', type=int, default=30,
+        help="count users modified in this many days as active")
+    parser.add_argument(
+        '--staleness', type=float, default=15,
+        help="read data this many seconds old")
+    parser.add_argument(
+        '--max_read_age', type=float, default=3000,
+        help="read ranges started this many seconds after the shared "
+             "timestamp at their own (keep below the database's "
+             "version_retention_period, 1h by default)")
+    parser.add_argument(
+        '--report', default="-",
+        help="file to write the JSON report to ('-' for stdout)")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = get_args()
+    logging.info('Starting census.py')
+
+    spanner_read_data(args=args)
+
+    logging.info('Completed census.py')
@@ -1,19 +1,34 @@
 # Count the number of users in the spanner database
 # Specifically, the number of unique fxa_uid found in the user_collections table
 #
+# `--mode=exact` (the default) counts every user in one query.
+# `--mode=approximate` counts the users in a random sample of fxa_uid
+# ranges and scales the result up. `--mode=incremental` keeps a count per
+# range in a `--state` file and only recounts the `--refresh` ranges
+# that were counted longest ago, so it's cheap enough to run every few
+# minutes.
+#
 # This Source Code Form is subject to the terms of the Mozilla Public
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
 
+import argparse
+import json
+import math
 import os
+import random
 import sys
 import logging
-from datetime import datetime
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 from statsd.defaults.env import statsd
 from urllib import parse
 
 from google.cloud import spanner
 
+from key_ranges import key_ranges, range_conditions, range_name
+
 # set up logger
 logging.basicConfig(
     format='{"datetime": "%(asctime)s", "message": "%(message)s"}',
@@ -42,7 +57,92 @@ def from_env():
     return (instance_id, database_id)
 
 
-def spanner_read_data(request=None):
+def count_range(database, key_range, staleness):
+    """distinct fxa_uids in one range, read `staleness` ago"""
+    (conditions, params, types) = range_conditions(key_range)
+    query = ('SELECT COUNT (DISTINCT fxa_uid) FROM user_collections '
+             'WHERE {}'.format(conditions))
+    with database.snapshot(exact_staleness=staleness) as snapshot:
+        result = snapshot.execute_sql(
+            query, params=params, param_types=types)
+        return result.one()[0]
+
+
+def count_ranges(database, ranges, args):
+    """count several ranges in parallel, returns [(range, count)]"""
+    staleness = timedelta(seconds=args.staleness)
+    with ThreadPoolExecutor(max_workers=args.parallelism) as pool:
+        counts = pool.map(
+            lambda key_range: count_range(database, key_range, staleness),
+            ranges)
+        return list(zip(ranges, counts))
+
+
+def count_approximate(database, args):
+    """scale up the users counted in a random sample of ranges.
+
+    fxa_uids are random, so every range holds about the same number of
+    users, and the spread of the sampled counts gives the error.
+
+    """
+    ranges = key_ranges(args.ranges)
+    sample = random.sample(ranges, min(args.sample_ranges, len(ranges)))
+    counts = [count for (key_range, count) in
+              count_ranges(database, sample, args)]
+    (total, sampled) = (len(ranges), len(counts))
+    mean = sum(counts) / sampled
+    variance = sum((count - mean) ** 2 for count in counts) / max(
+        sampled - 1, 1)
+    error = total * math.sqrt(variance / sampled * (1 - sampled / total))
+    logging.info("Sampled {} of {} ranges, standard error {}".format(
+        sampled, total, int(error)))
+    return int(mean * total)
+
+
+def load_state(path, count):
+    """the {range name: [users, counted at]} kept by a previous run"""
+    if path and os.path.exists(path):
+        with open(path) as state_file:
+            state = json.load(state_file)
+        if state.get("ranges") == count:
+            return state["counts"]
+        logging.info("Range count changed, starting over")
+    return {}
+
+
+def save_state(path, count, counts):
+    tmp = "{}.{}".format(path, os.getpid())
+    with open(tmp, "w") as state_file:
+        json.dump({"ranges": count, "counts": counts}, state_file)
+    os.replace(tmp, path)
+
+
+def count_incremental(database, args):
+    """recount the stalest ranges, and sum with the rest of the state"""
+    ranges = key_ranges(args.ranges)
+    counts = load_state(args.state, len(ranges))
+    # ranges that were never counted sort first, then the oldest counts.
+    # Every range has to be counted once before the total makes sense.
+    stale = sorted(
+        ranges,
+        key=lambda key_range: counts.get(range_name(key_range), [0, 0])[1])
+    missing = len([
+        key_range for key_range in ranges
+        if range_name(key_range) not in counts])
+    refresh = stale[:max(args.refresh, missing)]
+    now = time.time()
+    for (key_range, count) in count_ranges(database, refresh, args):
+        counts[range_name(key_range)] = [count, now]
+    if args.state:
+        save_state(args.state, len(ranges), counts)
+    oldest = min(counted for (count, counted) in counts.values())
+    statsd.gauge("syncstorage.count_users.oldest_range_seconds", now - oldest)
+    logging.info("Recounted {} of {} ranges".format(len(refresh), len(ranges)))
+    return sum(count for (count, counted) in counts.values())
+
+
+def spanner_read_data(request=None, args=None):
+    args = args or get_args([])
     (instance_id, database_id) = from_env()
     instance = client.instance(instance_id)
     database = instance.database(database_id)
@@ -51,17 +151,52 @@ def spanner_read_data(request=None):
 
     # Count users
     with statsd.timer("syncstorage.count_users.duration"):
-        with database.snapshot() as snapshot:
-            query = 'SELECT COUNT (DISTINCT fxa_uid) FROM user_collections'
-            result = snapshot.execute_sql(query)
-            user_count = result.one()[0]
-            statsd.gauge("syncstorage.distinct_fxa_uid", user_count)
-            logging.info("Count found {} distinct users".format(user_count))
+        if args.mode == "approximate":
+            user_count = count_approximate(database, args)
+        elif args.mode == "incremental":
+            user_count = count_incremental(database, args)
+        else:
+            with database.snapshot() as snapshot:
+                query = ('SELECT COUNT (DISTINCT fxa_uid) '
+                         'FROM user_collections')
+                result = snapshot.execute_sql(query)
+                user_count = result.one()[0]
+        statsd.gauge("syncstorage.distinct_fxa_uid", user_count)
+        logging.info("Count found {} distinct users".format(user_count))
+    return user_count
+
+
+def get_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Count the distinct users in Spanner")
+    parser.add_argument(
+        '--mode', choices=("exact", "approximate", "incremental"),
+        default="exact", help="how to count")
+    parser.add_argument(
+        '--ranges', type=int, default=256,
+        help="number of fxa_uid ranges to split user_collections into")
+    parser.add_argument(
+        '--sample_ranges', type=int, default=16,
+        help="approximate: number of ranges to count")
+    parser.add_argument(
+        '--state', default="count_users.json",
+        help="incremental: file keeping the count of every range")
+    parser.add_argument(
+        '--refresh', type=int, default=16,
+        help="incremental: number of ranges to recount per run")
+    parser.add_argument(
+        '--parallelism', type=int, default=4,
+        help="maximum number of ranges counted at once")
+    parser.add_argument(
+        '--staleness', type=float, default=15,
+        help="approximate/incremental: read data this many seconds old")
+    return parser.parse_args(argv)
 
 
 if __name__ == "__main__":
+    args = get_args()
     logging.info('Starting count_users.py')
 
-    spanner_read_data()
+    spanner_read_data(args=args)
 
     logging.info('Completed count_users.py')
@@ -0,0 +1,479 @@
+# Generate Synthetic Sync Data
+#
+# Produces users whose data is shaped like real sync storage: a Zipf
+# like number of BSOs per user, spread over the built-in collections,
+# with payload sizes drawn from a histogram and a spread of sortindex,
+# modified and expiry values. The same corpus (for a given --seed) can
+# be written to spanner, to the MySQL bso{N} tables (along with the
+# matching tokenserver users.csv) or to Avro files, so that the
+# migrator, purge and count tools can all be load tested on it.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import argparse
+import base64
+import binascii
+import logging
+import os
+import random
+import string
+import sys
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+from urllib import parse
+
+# set up logger
+logging.basicConfig(
+    format='{"datetime": "%(asctime)s", "message": "%(message)s"}',
+    stream=sys.stdout,
+    level=logging.INFO)
+
+COLLECTIONS = {
+    "clients": 1,
+    "crypto": 2,
+    "forms": 3,
+    "history": 4,
+    "keys": 5,
+    "meta": 6,
+    "bookmarks": 7,
+    "prefs": 8,
+    "tabs": 9,
+    "passwords": 10,
+    "addons": 11,
+    "addresses": 12,
+    "creditcards": 13,
+}
+# Every user has a meta/global and a crypto/keys record.
+FIXED_BSOS = (("meta", "global"), ("crypto", "keys"))
+# Share of a user's remaining BSOs held by each collection.
+DEFAULT_MIX = ("history=60,bookmarks=15,forms=12,passwords=3,tabs=2,"
+               "prefs=2,addons=2,clients=2,addresses=1,creditcards=1")
+# Payload size buckets (upper bound=weight); sizes are uniform within a
+# bucket.
+DEFAULT_SIZES = "400=30,1000=30,2500=20,8000=15,25000=5"
+
+# Earliest generated keys_changed_at (ms), 2019-01-01.
+GENERATION_BASE = 1546300800000
+
+# Spanner per commit limits (see write_batch.py)
+MAX_MUTATIONS = 20000
+MAX_COMMIT_BYTES = 104857600
+BSO_COLUMNS = (
+    'fxa_uid', 'fxa_kid', 'collection_id', 'bso_id', 'sortindex',
+    'payload', 'modified', 'expiry')
+# each bsos row also writes an entry in BsoModified and BsoExpiry
+BSO_MUTATIONS = len(BSO_COLUMNS) + 2
+
+
+def from_env():
+    try:
+        url = os.environ.get("SYNC_DATABASE_URL")
+        if not url:
+            raise Exception("no url")
+        purl = parse.urlparse(url)
+        if purl.scheme == "spanner":
+            path = purl.path.split("/")
+            instance_id = path[-3]
+            database_id = path[-1]
+    except Exception as e:
+        # Change these to reflect your Spanner instance install
+        print("Exception {}".format(e))
+        instance_id = os.environ.get("INSTANCE_ID", "spanner-test")
+        database_id = os.environ.get("DATABASE_ID", "sync_stage")
+    return (instance_id, database_id)
+
+
+def parse_weights(spec):
+    """parse "key=weight,..." into ([key, ...], [weight, ...])"""
+    keys = []
+    weights = []
+    for item in spec.split(","):
+        (key, weight) = item.split("=")
+        keys.append(key.strip())
+        weights.append(float(weight))
+    return (keys, weights)
+
+
+class User:
+    def __init__(self, userid, fxa_uid, generation, client_state):
+        self.userid = userid
+        self.fxa_uid = fxa_uid
+        self.generation = generation
+        self.client_state = client_state
+        self.fxa_kid = "{:013d}-{}".format(
+            generation,
+            base64.urlsafe_b64encode(client_state).rstrip(b'=').decode(
+                'ascii'))
+
+
+class Corpus:
+    """Deterministic (per --seed) stream of users and their BSOs"""
+    def __init__(self, args):
+        self.args = args
+        self.rand = random.Random(args.seed)
+        (names, self.mix_weights) = parse_weights(args.collection_mix)
+        self.mix = [COLLECTIONS[name] for name in names]
+        (bounds, self.size_weights) = parse_weights(args.payload_sizes)
+        bounds = [int(bound) for bound in bounds]
+        self.size_buckets = list(zip([1] + bounds[:-1], bounds))
+        # payloads are slices of one random, base64 like, string.
+        alphabet = string.ascii_letters + string.digits + "-_"
+        self.pool = ''.join(
+            self.rand.choice(alphabet) for _ in range(max(bounds) * 2))
+        self.now = datetime.utcnow().replace(microsecond=0)
+
+    def users(self):
+        for n in range(self.args.users):
+            yield User(
+                userid=self.args.start_uid + n,
+                fxa_uid=binascii.hexlify(
+                    self.rand.getrandbits(128).to_bytes(16, 'big')).decode(),
+                generation=GENERATION_BASE + self.rand.randint(
+                    0, 86400000 * 365),
+                client_state=self.rand.getrandbits(128).to_bytes(16, 'big'))
+
+    def bso_count(self):
+        """a Zipf like (Pareto distributed) number of BSOs for a user"""
+        return min(
+            self.args.max_bsos,
+            int(self.args.min_bsos * self.rand.paretovariate(
+                self.args.skew)))
+
+    def collections(self):
+        """[(collection_id, [bso_id, ...]), ...] for the next user"""
+        counts = Counter(self.rand.choices(
+            self.mix, self.mix_weights, k=self.bso_count()))
+        bsos = dict((COLLECTIONS[name], [bso_id])
+                    for (name, bso_id) in FIXED_BSOS)
+        for (collection_id, count) in counts.items():
+            bsos.setdefault(collection_id, []).extend(
+                self.bso_id() for _ in range(count))
+        return sorted(bsos.items())
+
+    def bso_id(self):
+        # sync ids are 12 url safe base64 characters.
+        return base64.urlsafe_b64encode(
+            self.rand.getrandbits(72).to_bytes(9, 'big')).decode('ascii')
+
+    def payload(self):
+        (low, high) = self.rand.choices(
+            self.size_buckets, self.size_weights)[0]
+        size = self.rand.randint(low, high)
+        start = self.rand.randrange(len(self.pool) - size)
+        return self.pool[start:start + size]
+
+    def bso(self, bso_id):
+        """(bso_id, sortindex, payload, modified, expiry)"""
+        args = self.args
+        sortindex = None
+        if self.rand.random() >= args.null_sortindex:
+            sortindex = self.rand.randint(0, args.max_sortindex)
+        modified = self.now - timedelta(
+            seconds=self.rand.uniform(0, args.modified_days * 86400))
+        if self.rand.random() < args.expired:
+            # already expired, for the purge tools to find.
+            expiry = self.now - timedelta(
+                seconds=self.rand.uniform(1, args.modified_days * 86400))
+        else:
+            (low, high) = args.ttl_days.split(":")
+            expiry = self.now + timedelta(
+                days=self.rand.uniform(float(low), float(high)))
+        return (bso_id, sortindex, self.payload(), modified, expiry)
+
+
+def to_millis(dt):
+    return int((dt - datetime(1970, 1, 1)).total_seconds() * 1000)
+
+
+class SpannerSink:
+    """Write users to the bsos and user_collections tables."""
+    def __init__(self, args):
+        from google.cloud import spanner
+
+        (instance_id, database_id) = from_env()
+        self.database = spanner.Client().instance(
+            instance_id).database(database_id)
+        self.max_mutations = int(MAX_MUTATIONS * 0.9)
+        self.max_bytes = int(MAX_COMMIT_BYTES * 0.9)
+
+    def write(self, user, collection_id, bsos, now):
+        # bsos are interleaved in user_collections, so that goes first.
+        with self.database.batch() as batch:
+            batch.insert_or_update(
+                'user_collections',
+                columns=('fxa_uid', 'fxa_kid', 'collection_id', 'modified'),
+                values=[(user.fxa_uid, user.fxa_kid, collection_id, now)])
+        records = []
+        size = 0
+        for (bso_id, sortindex, payload, modified, expiry) in bsos:
+            record = (user.fxa_uid, user.fxa_kid, collection_id, bso_id,
+                      sortindex, payload, modified, expiry)
+            record_size = 3 * len(user.fxa_uid) + len(payload) + 64
+            if records and (
+                    (len(records) + 1) * BSO_MUTATIONS > self.max_mutations
+                    or size + record_size > self.max_bytes):
+                self.commit(records)
+                records = []
+                size = 0
+            records.append(record)
+            size += record_size
+        if records:
+            self.commit(records)
+
+    def commit(self, records):
+        with self.database.batch() as batch:
+            batch.insert_or_update(
+                'bsos', columns=BSO_COLUMNS, values=records)
+
+    def close(self):
+        pass
+
+
+class MySQLSink:
+    """Write users to the MySQL bso{N} shards, plus a users.csv token file
+    (`userid % --shards` picks the shard)."""
+    def __init__(self, args):
+        from mysql import connector
+
+        dsn = parse.urlparse(args.dsn)
+        self.connection = connector.connect(
+            user=dsn.username,
+            password=dsn.password,
+            host=dsn.hostname,
+            port=dsn.port or 3306,
+            database=dsn.path[1:])
+        self.shards = args.shards
+        self.batch_rows = args.batch_rows
+        cursor = self.connection.cursor()
+        try:
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS collections (
+                    collectionid INT NOT NULL PRIMARY KEY,
+                    name VARCHAR(32) NOT NULL UNIQUE)""")
+            cursor.executemany(
+                "INSERT IGNORE INTO collections VALUES (%s, %s)",
+                [(cid, name) for (name, cid) in COLLECTIONS.items()])
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS user_collections (
+                    userid INT NOT NULL,
+                    collection INT NOT NULL,
+                    last_modified BIGINT NOT NULL,
+                    PRIMARY KEY (userid, collection))""")
+            for bso_num in range(self.shards):
+                cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS bso{} (
+                        userid INT NOT NULL,
+                        collection INT NOT NULL,
+                        id VARCHAR(64) NOT NULL,
+                        sortindex INT,
+                        modified BIGINT NOT NULL,
+                        payload MEDIUMTEXT NOT NULL,
+                        payload_size INT NOT NULL DEFAULT 0,
+                        ttl INT NOT NULL,
+                        PRIMARY KEY (userid, collection, id))""".format(
+                    bso_num))
+            self.connection.commit()
+        finally:
+            cursor.close()
+        self.token_file = open(args.token_file, "w")
+        self.token_file.write(
+            "uid\temail\tgeneration\tkeys_changed_at\tclient_state\n")
+        self.users = set()
+
+    def write(self, user, collection_id, bsos, now):
+        if user.userid not in self.users:
+            self.users.add(user.userid)
+            self.token_file.write("{}\t{}@api.accounts.firefox.com\t{}\t\t"
+                                  "{}\n".format(
+                                      user.userid, user.fxa_uid,
+                                      user.generation,
+                                      binascii.hexlify(
+                                          user.client_state).decode()))
+        sql = ("INSERT INTO bso{} (userid, collection, id, sortindex, "
+               "modified, payload, payload_size, ttl) VALUES "
+               "(%s, %s, %s, %s, %s, %s, %s, %s)").format(
+                   user.userid % self.shards)
+        cursor = self.connection.cursor()
+        try:
+            cursor.execute(
+                "REPLACE INTO user_collections VALUES (%s, %s, %s)",
+                (user.userid, collection_id, to_millis(now)))
+            records = []
+            for (bso_id, sortindex, payload, modified, expiry) in bsos:
+                records.append((
+                    user.userid, collection_id, bso_id, sortindex,
+                    to_millis(modified), payload, len(payload),
+                    to_millis(expiry) // 1000))
+                if len(records) >= self.batch_rows:
+                    cursor.executemany(sql, records)
+                    records = []
+            if records:
+                cursor.executemany(sql, records)
+            self.connection.commit()
+        finally:
+            cursor.close()
+
+    def close(self):
+        self.token_file.close()
+        self.connection.close()
+
+
+class AvroSink:
+    """Write BSOs to sync.avsc Avro files of up to --avro_rows records,
+    named `{output}_{chunk}.avso`. Times are in microseconds, like
+    ../user_migration/old/dump_avro.py."""
+    def __init__(self, args):
+        import avro.schema
+        from avro.datafile import DataFileWriter
+        from avro.io import DatumWriter
+
+        self.writer_class = DataFileWriter
+        self.datum_writer = DatumWriter
+        self.schema = avro.schema.parse(open(args.schema, "rb").read())
+        self.output = args.avro_output.rsplit('.', 1)
+        self.max_rows = args.avro_rows
+        self.chunk = 0
+        self.rows = 0
+        self.writer = None
+
+    def open(self):
+        if self.writer:
+            self.writer.close()
+        file_name = "{}_{}.{}".format(
+            self.output[0], hex(self.chunk), self.output[1])
+        self.writer = self.writer_class(
+            open(file_name, "wb"), self.datum_writer(), self.schema)
+        self.chunk += 1
+        self.rows = 0
+
+    def write(self, user, collection_id, bsos, now):
+        for (bso_id, sortindex, payload, modified, expiry) in bsos:
+            if self.writer is None or self.rows >= self.max_rows:
+                self.open()
+            self.writer.append({
+                "fxa_uid": user.fxa_uid,
+                "fxa_kid": user.fxa_kid,
+                "collection_id": collection_id,
+                "bso_id": bso_id,
+                "expiry": to_millis(expiry) * 1000,
+                "modified": to_millis(modified) * 1000,
+                "payload": payload,
+                "sortindex": sortindex})
+            self.rows += 1
+
+    def close(self):
+        if self.writer:
+            self.writer.close()
+
+
+SINKS = {
+    "spanner": SpannerSink,
+    "mysql": MySQLSink,
+    "avro": AvroSink,
+}
+
+
+def get_args():
+    parser = argparse.ArgumentParser(
+        description="generate synthetic sync data")
+    parser.add_argument(
+        '--output', choices=sorted(SINKS), default="spanner",
+        help="where to write the data (spanner uses SYNC_DATABASE_URL)")
+    parser.add_argument(
+        '--users', type=int, default=1000,
+        help="number of users to generate")
+    parser.add_argument(
+        '--start_uid', type=int, default=1,
+        help="first (tokenserver) userid")
+    parser.add_argument(
+        '--seed', type=int, default=1,
+        help="random seed; the same seed produces the same corpus")
+    parser.add_argument(
+        '--min_bsos', type=int, default=20,
+        help="smallest number of BSOs per user")
+    parser.add_argument(
+        '--max_bsos', type=int, default=200000,
+        help="largest number of BSOs per user")
+    parser.add_argument(
+        '--skew', type=float, default=1.2,
+        help="Pareto shape of the BSOs per user (lower is more skewed)")
+    parser.add_argument(
+        '--collection_mix', default=DEFAULT_MIX,
+        help="share of BSOs per collection (name=weight,...)")
+    parser.add_argument(
+        '--payload_sizes', default=DEFAULT_SIZES,
+        help="payload size histogram (upper bound=weight,...)")
+    parser.add_argument(
+        '--max_sortindex', type=int, default=2000000,
+        help="largest sortindex")
+    parser.add_argument(
+        '--null_sortindex', type=float, default=0.5,
+        help="fraction of BSOs without a sortindex")
+    parser.add_argument(
+        '--modified_days', type=float, default=365,
+        help="spread modified times over this many past days")
+    parser.add_argument(
+        '--ttl_days', default="30:3650",
+        help="range of days until unexpired BSOs expire (min:max)")
+    parser.add_argument(
+        '--expired', type=float, default=0.05,
+        help="fraction of BSOs that have already expired")
+    parser.add_argument(
+        '--dsn',
+        help="mysql DSN for --output=mysql")
+    parser.add_argument(
+        '--shards', type=int, default=20,
+        help="number of bso{N} tables for --output=mysql")
+    parser.add_argument(
+        '--token_file', default="users.csv",
+        help="tokenserver users file written for --output=mysql")
+    parser.add_argument(
+        '--batch_rows', type=int, default=1000,
+        help="rows per insert for --output=mysql")
+    parser.add_argument(
+        '--schema',
+        default=os.path.join(
+            os.path.dirname(__file__), "..", "user_migration", "old",
+            "sync.avsc"),
+        help="Avro schema for --output=avro")
+    parser.add_argument(
+        '--avro_output', default="generated.avso",
+        help="Avro file name prefix for --output=avro")
+    parser.add_argument(
+        '--avro_rows', type=int, default=1500000,
+        help="records per Avro file for --output=avro")
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    corpus = Corpus(args)
+    sink = SINKS[args.output](args)
+    start = time.time()
+    totals = Counter()
+
+    def bsos(bso_ids):
+        # generated as they are written, heavy users can be large.
+        for bso_id in bso_ids:
+            bso = corpus.bso(bso_id)
+            totals['rows'] += 1
+            totals['bytes'] += len(bso[2])
+            yield bso
+
+    try:
+        for user in corpus.users():
+            for (collection_id, bso_ids) in corpus.collections():
+                sink.write(user, collection_id, bsos(bso_ids), corpus.now)
+            logging.info("User {} ({}): {} rows, {} payload bytes".format(
+                user.userid, user.fxa_uid, totals['rows'], totals['bytes']))
+    finally:
+        sink.close()
+    logging.info("Generated {} users, {} rows, {} payload bytes in {}".format(
+        args.users, totals['rows'], totals['bytes'], time.time() - start))
+
+
+if __name__ == '__main__':
+    main()
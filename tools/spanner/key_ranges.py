@@ -0,0 +1,49 @@
+# fxa_uid key ranges, for the scripts here that split their work (and
+# their queries) by user.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+from google.cloud.spanner_v1 import param_types
+
+
+def key_ranges(count):
+    """split the fxa_uid keyspace into `count` (start, end) ranges.
+
+    The boundaries are evenly spaced hex prefixes. The first range has no
+    start and the last no end, so every fxa_uid falls in exactly one
+    range.
+
+    """
+    if count <= 1:
+        return [(None, None)]
+    width = 1
+    while 16 ** width < count:
+        width += 1
+    bounds = [None] + [
+        "{:0{}x}".format(i * 16 ** width // count, width)
+        for i in range(1, count)
+    ] + [None]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def range_name(key_range):
+    return "{}..{}".format(key_range[0] or "", key_range[1] or "")
+
+
+def range_conditions(key_range, *conditions):
+    """the WHERE conditions, params and param_types for the rows of one
+    range, and'ed with any extra `conditions`"""
+    (start, end) = key_range
+    clauses = []
+    params = {}
+    if start is not None:
+        clauses.append("fxa_uid >= @start")
+        params["start"] = start
+    if end is not None:
+        clauses.append("fxa_uid < @end")
+        params["end"] = end
+    clauses.extend(conditions)
+    types = dict((name, param_types.STRING) for name in params)
+    return (" AND ".join(clauses) or "TRUE", params, types)
@@ -1,17 +1,48 @@
 # Purge Expired TTLs
 #
+# By default each table is purged with a single partitioned DML. With
+# `--ranges=N` the fxa_uid keyspace is split into N prefix ranges that are
+# purged concurrently (at most `--parallelism` at a time), and with
+# `--checkpoint` finished ranges are recorded so that an interrupted
+# purge can be resumed.
+#
+# `--mode=chunked` instead deletes expired rows in small transactions.
+# Their keys are found through the BatchExpiry and BsoExpiry indexes in
+# read-only snapshots, and each chunk's DML re-checks the expiry of just
+# those rows, so only they are locked. The chunk size
+# follows the commit latency (`--target_latency`) and the run stops
+# cleanly once `--max_duration` or `--max_rows` is used up, so that a
+# nightly purge has a predictable impact on live traffic.
+#
+# `--estimate` doesn't delete anything. It counts the expired rows in a
+# random sample of fxa_uid ranges using stale (lock free) reads, and
+# reports the expected number of rows, per table and collection, and how
+# long purging them should take.
+#
 # This Source Code Form is subject to the terms of the Mozilla Public
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
 
+import argparse
+import json
 import os
+import random
 import sys
 import logging
-from datetime import datetime
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta
 from statsd.defaults.env import statsd
 from urllib import parse
 
+from google.api_core.exceptions import (
+    DeadlineExceeded, InvalidArgument, ResourceExhausted, ServiceUnavailable)
 from google.cloud import spanner
+from google.cloud.spanner_v1 import param_types
+
+from key_ranges import key_ranges, range_conditions
 
 # set up logger
 logging.basicConfig(
@@ -22,6 +53,101 @@ logging.basicConfig(
 # Change these to match your install.
 client = spanner.Client()
 
+# table => statsd metric prefix
+TABLES = (("batches", "batches"), ("bsos", "bso"))
+
+MAX_MUTATIONS = 20000
+KEY_COLUMNS = ("fxa_uid", "fxa_kid", "collection_id")
+
+# table => (expiry index, last primary key column, mutations per deleted
+# row: the row itself plus its index entries)
+CHUNKED = {
+    "batches": ("BatchExpiry", "batch_id", 2),
+    "bsos": ("BsoExpiry", "bso_id", 3),
+}
+
+# Errors after which a smaller chunk is worth retrying.
+SHRINK_ERRORS = (
+    DeadlineExceeded, InvalidArgument, ResourceExhausted, ServiceUnavailable)
+MAX_FAILURES = 5
+
+
+class Checkpoint:
+    """(table, start, end) ranges finished by a purge, kept in a file"""
+    def __init__(self, path=None):
+        self.path = path
+        self.lock = threading.Lock()
+        self.finished = set()
+        if path and os.path.exists(path):
+            with open(path) as journal:
+                for line in journal:
+                    self.finished.add(tuple(json.loads(line)))
+
+    def __contains__(self, key):
+        return key in self.finished
+
+    def done(self, table, key_range):
+        key = (table,) + tuple(key_range)
+        with self.lock:
+            self.finished.add(key)
+            if self.path:
+                with open(self.path, "a") as journal:
+                    journal.write(json.dumps(key) + "\n")
+
+    def clear(self):
+        """forget everything, once the whole purge has finished"""
+        self.finished = set()
+        if self.path and os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def range_query(table, key_range):
+    """the partitioned DML, params and param_types purging one range"""
+    (conditions, params, types) = range_conditions(
+        key_range, "expiry < CURRENT_TIMESTAMP()")
+    query = "DELETE FROM {} WHERE {}".format(table, conditions)
+    return (query, params, types)
+
+
+def purge_range(database, table, metric, key_range):
+    (query, params, types) = range_query(table, key_range)
+    with statsd.timer("syncstorage.purge_ttl.{}_range_duration".format(
+            metric)):
+        start = datetime.now()
+        result = database.execute_partitioned_dml(
+            query, params=params, param_types=types)
+        duration = datetime.now() - start
+    statsd.incr("syncstorage.purge_ttl.{}_rows".format(metric), result)
+    logging.info("{}: removed {} rows from {}..{}, duration: {}".format(
+        table, result, key_range[0] or "", key_range[1] or "", duration))
+    return result
+
+
+def purge_table(database, table, metric, args, checkpoint):
+    """purge every unfinished range of a table, returns the rows removed"""
+    ranges = [
+        key_range for key_range in key_ranges(args.ranges)
+        if (table,) + key_range not in checkpoint
+    ]
+    skipped = args.ranges - len(ranges)
+    if skipped > 0:
+        logging.info("{}: skipping {} finished ranges".format(table, skipped))
+    total = 0
+    with ThreadPoolExecutor(max_workers=args.parallelism) as pool:
+        futures = dict(
+            (pool.submit(purge_range, database, table, metric, key_range),
+             key_range)
+            for key_range in ranges)
+        try:
+            for future in as_completed(futures):
+                total += future.result()
+                checkpoint.done(table, futures[future])
+        except Exception:
+            for future in futures:
+                future.cancel()
+            raise
+    return total
+
 
 def from_env():
     try:
@@ -41,39 +167,329 @@ def from_env():
     return (instance_id, database_id)
 
 
-def spanner_read_data(request=None):
+class Budget:
+    """How long, and how many rows, a chunked purge may still take"""
+    def __init__(self, max_duration=None, max_rows=None):
+        self.deadline = time.time() + max_duration if max_duration else None
+        self.rows_left = max_rows
+
+    def spend(self, rows):
+        if self.rows_left is not None:
+            self.rows_left -= rows
+
+    def exhausted(self):
+        if self.deadline and time.time() >= self.deadline:
+            return True
+        return self.rows_left is not None and self.rows_left <= 0
+
+    def limit(self, size):
+        if self.rows_left is None:
+            return size
+        return min(size, self.rows_left)
+
+
+class ChunkSize:
+    """Rows per chunk, adjusted to keep commits near a target latency"""
+    def __init__(self, initial, low, high, target):
+        self.low = low
+        self.high = high
+        self.target = target
+        self.size = max(low, min(high, initial))
+
+    def update(self, latency):
+        if latency > self.target:
+            # shrink in proportion to how far over target we were.
+            size = self.size * self.target / latency
+        else:
+            size = self.size * 1.25 + 1
+        self.size = max(self.low, min(self.high, int(size)))
+
+    def failed(self):
+        self.size = max(self.low, self.size // 2)
+
+
+def expired_query(table, cursor=None):
+    """read up to @limit expired primary keys of `table` via its index"""
+    (index, last_key, mutations) = CHUNKED[table]
+    columns = ", ".join(KEY_COLUMNS + (last_key,))
+    conditions = ["expiry < CURRENT_TIMESTAMP()"]
+    order = ""
+    if table == "bsos":
+        # BsoExpiry is interleaved, so walk it in key order, picking up
+        # from the last fxa_uid seen instead of rescanning live rows.
+        order = " ORDER BY {}".format(", ".join(KEY_COLUMNS))
+        if cursor is not None:
+            conditions.insert(0, "fxa_uid >= @cursor")
+    return ("SELECT {} FROM {}@{{FORCE_INDEX={}}} WHERE {}{} "
+            "LIMIT @limit").format(
+                columns, table, index, " AND ".join(conditions), order)
+
+
+def expired_keys(database, table, limit, cursor):
+    """up to `limit` expired primary keys of `table`.
+
+    The index scan runs in a read-only snapshot, so it takes no locks on
+    the (mostly live) rows it walks past.
+
+    """
+    params = {"limit": limit}
+    types = {"limit": param_types.INT64}
+    if cursor is not None:
+        params["cursor"] = cursor
+        types["cursor"] = param_types.STRING
+    with database.snapshot() as snapshot:
+        return [
+            tuple(row) for row in snapshot.execute_sql(
+                expired_query(table, cursor), params=params,
+                param_types=types)
+        ]
+
+
+def key_columns(table):
+    """the (name, type) of each column of a `table` primary key"""
+    return (("fxa_uid", "STRING"), ("fxa_kid", "STRING"),
+            ("collection_id", "INT64"), (CHUNKED[table][1], "STRING"))
+
+
+def delete_query(table):
+    """DML deleting the @keys rows of `table` that are still expired"""
+    columns = key_columns(table)
+    return ("DELETE FROM {} WHERE STRUCT<{}>({}) IN UNNEST(@keys) "
+            "AND expiry < CURRENT_TIMESTAMP()").format(
+                table,
+                ", ".join("{} {}".format(*column) for column in columns),
+                ", ".join(name for (name, type_name) in columns))
+
+
+def key_type(table):
+    """the param_type of a list of `table` primary keys"""
+    return param_types.Array(param_types.Struct([
+        param_types.StructField(name, getattr(param_types, type_name))
+        for (name, type_name) in key_columns(table)]))
+
+
+def delete_expired(transaction, table, keys):
+    """delete the rows of `keys` that are still expired, returns how many.
+
+    Only the rows themselves are locked. Checking expiry again leaves
+    rows whose expiry was extended since they were read alone.
+
+    """
+    return transaction.execute_update(
+        delete_query(table), params={"keys": keys},
+        param_types={"keys": key_type(table)})
+
+
+def purge_chunked(database, table, metric, args, budget):
+    """purge `table` chunk by chunk until done or out of budget"""
+    mutations = CHUNKED[table][2]
+    sizer = ChunkSize(
+        args.chunk_size, args.min_chunk_size,
+        min(args.max_chunk_size, MAX_MUTATIONS // mutations),
+        args.target_latency)
+    cursor = None
+    total = 0
+    failures = 0
+    while not budget.exhausted():
+        limit = budget.limit(sizer.size)
+        try:
+            keys = expired_keys(database, table, limit, cursor)
+            if not keys:
+                return total
+            start = time.time()
+            deleted = database.run_in_transaction(
+                delete_expired, table, keys)
+        except SHRINK_ERRORS as ex:
+            failures += 1
+            if failures > MAX_FAILURES:
+                raise
+            sizer.failed()
+            logging.warning("{}: chunk of {} failed, retrying with {}: {}"
+                            .format(table, limit, sizer.size, ex))
+            continue
+        latency = time.time() - start
+        failures = 0
+        statsd.timing(
+            "syncstorage.purge_ttl.{}_chunk_duration".format(metric),
+            latency * 1000)
+        statsd.incr("syncstorage.purge_ttl.{}_rows".format(metric), deleted)
+        statsd.gauge(
+            "syncstorage.purge_ttl.{}_chunk_size".format(metric), limit)
+        total += deleted
+        budget.spend(deleted)
+        if table == "bsos":
+            cursor = keys[-1][0]
+        sizer.update(latency)
+        if args.pause:
+            time.sleep(args.pause)
+    logging.info("{}: budget exhausted after removing {} rows".format(
+        table, total))
+    return total
+
+
+def collection_names(database, staleness):
+    with database.snapshot(exact_staleness=staleness) as snapshot:
+        return dict(snapshot.execute_sql(
+            "SELECT collection_id, name FROM collections"))
+
+
+def estimate_range(database, table, key_range, staleness):
+    """expired rows per collection_id in one range of `table`"""
+    (conditions, params, types) = range_conditions(
+        key_range, "expiry < CURRENT_TIMESTAMP()")
+    query = ("SELECT collection_id, COUNT(*) FROM {}@{{FORCE_INDEX={}}} "
+             "WHERE {} GROUP BY collection_id").format(
+                 table, CHUNKED[table][0], conditions)
+    with database.snapshot(exact_staleness=staleness) as snapshot:
+        return dict(snapshot.execute_sql(
+            query, params=params, param_types=types))
+
+
+def estimate_expired(database, args):
+    """estimate the rows a purge would remove, using only stale reads.
+
+    BatchExpiry is ordered by expiry, so expired batches are simply
+    counted. Expired bsos are counted in `--sample_ranges` random fxa_uid
+    ranges out of `--estimate_ranges`, and scaled up.
+
+    """
+    staleness = timedelta(seconds=args.staleness)
+    names = collection_names(database, staleness)
+    ranges = key_ranges(args.estimate_ranges)
+    sample = random.sample(ranges, min(args.sample_ranges, len(ranges)))
+    scale = len(ranges) / len(sample)
+    jobs = [("batches", (None, None), 1)] + [
+        ("bsos", key_range, scale) for key_range in sample]
+    estimates = dict((table, Counter()) for (table, metric) in TABLES)
+    with ThreadPoolExecutor(max_workers=args.parallelism) as pool:
+        futures = dict(
+            (pool.submit(
+                estimate_range, database, table, key_range, staleness),
+             (table, key_range, factor))
+            for (table, key_range, factor) in jobs)
+        for future in as_completed(futures):
+            (table, key_range, factor) = futures[future]
+            counts = future.result()
+            logging.info("{}: {} expired rows in {}..{}".format(
+                table, sum(counts.values()), key_range[0] or "",
+                key_range[1] or ""))
+            for (collection_id, count) in counts.items():
+                estimates[table][collection_id] += count * factor
+
+    total = 0
+    for (table, metric) in TABLES:
+        rows = int(sum(estimates[table].values()))
+        total += rows
+        statsd.gauge(
+            "syncstorage.purge_ttl.estimate.{}_rows".format(metric), rows)
+        logging.info("{}: ~{} expired rows".format(table, rows))
+        for (collection_id, count) in sorted(estimates[table].items()):
+            name = names.get(collection_id, str(collection_id))
+            statsd.gauge("syncstorage.purge_ttl.estimate.{}_rows.{}".format(
+                metric, name), int(count))
+            logging.info("{}: ~{} expired rows in {}".format(
+                table, int(count), name))
+    seconds = total / args.purge_rate
+    statsd.gauge("syncstorage.purge_ttl.estimate.duration", seconds)
+    logging.info(
+        "Estimated {} expired rows, ~{} to purge at {} rows/s".format(
+            total, timedelta(seconds=int(seconds)), args.purge_rate))
+    return total
+
+
+def spanner_read_data(request=None, args=None):
+    args = args or get_args([])
     (instance_id, database_id) = from_env()
     instance = client.instance(instance_id)
     database = instance.database(database_id)
 
     logging.info("For {}:{}".format(instance_id, database_id))
 
+    if args.estimate:
+        with statsd.timer("syncstorage.purge_ttl.estimate_duration"):
+            return estimate_expired(database, args)
+
+    checkpoint = Checkpoint(args.checkpoint)
+    budget = Budget(args.max_duration, args.max_rows)
+
     # Delete Batches. Also deletes child batch_bsos rows (INTERLEAVE
-    # IN PARENT batches ON DELETE CASCADE)
-    with statsd.timer("syncstorage.purge_ttl.batches_duration"):
-        batches_start = datetime.now()
-        query = 'DELETE FROM batches WHERE expiry < CURRENT_TIMESTAMP()'
-        result = database.execute_partitioned_dml(query)
-        batches_end = datetime.now()
-        logging.info("batches: removed {} rows, batches_duration: {}".format(
-            result, batches_end - batches_start))
-
-    # Delete BSOs
-    with statsd.timer("syncstorage.purge_ttl.bso_duration"):
-        bso_start = datetime.now()
-        query = 'DELETE FROM bsos WHERE expiry < CURRENT_TIMESTAMP()'
-        result = database.execute_partitioned_dml(query)
-        bso_end = datetime.now()
-        logging.info("bso: removed {} rows, bso_duration: {}".format(
-            result, bso_end - bso_start))
+    # IN PARENT batches ON DELETE CASCADE), then BSOs
+    for (table, metric) in TABLES:
+        with statsd.timer("syncstorage.purge_ttl.{}_duration".format(metric)):
+            start = datetime.now()
+            if args.mode == "chunked":
+                result = purge_chunked(database, table, metric, args, budget)
+            else:
+                result = purge_table(
+                    database, table, metric, args, checkpoint)
+            logging.info("{}: removed {} rows, {}_duration: {}".format(
+                metric, result, metric, datetime.now() - start))
+    if args.mode == "dml":
+        checkpoint.clear()
+
+
+def get_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Purge expired TTL records from Spanner")
+    parser.add_argument(
+        '--mode', choices=("dml", "chunked"), default="dml",
+        help="purge with partitioned DML, or in throttled chunks")
+    parser.add_argument(
+        '--ranges', type=int, default=1,
+        help="number of fxa_uid prefix ranges to split each table into")
+    parser.add_argument(
+        '--parallelism', type=int, default=4,
+        help="maximum number of ranges purged at once")
+    parser.add_argument(
+        '--checkpoint',
+        help="file recording finished ranges, to resume an interrupted "
+             "purge (removed once the purge completes)")
+    parser.add_argument(
+        '--chunk_size', type=int, default=500,
+        help="chunked: initial rows deleted per transaction")
+    parser.add_argument(
+        '--min_chunk_size', type=int, default=10,
+        help="chunked: smallest chunk size")
+    parser.add_argument(
+        '--max_chunk_size', type=int, default=5000,
+        help="chunked: largest chunk size")
+    parser.add_argument(
+        '--target_latency', type=float, default=1.0,
+        help="chunked: commit latency (seconds) the chunk size aims for")
+    parser.add_argument(
+        '--pause', type=float, default=0.0,
+        help="chunked: seconds to sleep between chunks")
+    parser.add_argument(
+        '--max_duration', type=float,
+        help="chunked: stop after this many seconds")
+    parser.add_argument(
+        '--max_rows', type=int,
+        help="chunked: stop after removing this many rows")
+    parser.add_argument(
+        '--estimate', action="store_true",
+        help="only estimate how many rows would be purged")
+    parser.add_argument(
+        '--staleness', type=float, default=15,
+        help="estimate: read data this many seconds old")
+    parser.add_argument(
+        '--estimate_ranges', type=int, default=256,
+        help="estimate: number of fxa_uid ranges to sample from")
+    parser.add_argument(
+        '--sample_ranges', type=int, default=16,
+        help="estimate: number of ranges to count expired bsos in")
+    parser.add_argument(
+        '--purge_rate', type=float, default=2000,
+        help="estimate: rows/s the planned purge removes")
+    return parser.parse_args(argv)
 
 
 if __name__ == "__main__":
+    args = get_args()
     with statsd.timer("syncstorage.purge_ttl.total_duration"):
         start_time = datetime.now()
         logging.info('Starting purge_ttl.py')
 
-        spanner_read_data()
+        spanner_read_data(args=args)
 
         end_time = datetime.now()
         duration = end_time - start_time
@@ -4,9 +4,14 @@
 # data stored. This script preloads a minimal set of data to trigger
 # that level of optimization.
 #
+# Writes are spread over many random users, and the number of batches
+# in flight adapts to commit latency and errors, to reach that target
+# as quickly as spanner allows.
+#
 # This Source Code Form is subject to the terms of the Mozilla Public
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
+import binascii
 import os
 from urllib import parse
 
@@ -16,10 +21,12 @@ import uuid
 from datetime import datetime, timedelta
 
 import threading
+import time
 
-from google.api_core.exceptions import AlreadyExists
+from google.api_core.exceptions import (
+    AlreadyExists, Aborted, DeadlineExceeded, ResourceExhausted,
+    ServiceUnavailable)
 from google.cloud import spanner
-from google.cloud.spanner_v1 import param_types
 
 
 # max batch size for this write is 2000, otherwise we run into:
@@ -46,13 +53,20 @@ Spanner. Please reduce the size or number of the writes, or use fewer
 indexes. (Maximum size: 104857600)
 
 """
-# 1 Batch of 2K records with payload of 25K = 201_168_000B
-# so, ~300G would need 2_982_582 batches
-BATCH_SIZE = 2000
-# Total number of threads to use
-THREAD_COUNT = 16
-# Number of batches per thread
-BATCHES = 330
+# Every bsos row costs 10 mutations (8 columns plus its BsoModified and
+# BsoExpiry index entries), so 2000 rows is the most a batch can hold.
+# Leave room for the batch's user_collections row.
+# 1 Batch of 2K records with payload of 25K = ~50_000_000B
+# so, ~300G would need ~6_000 batches
+BATCH_SIZE = 1990
+# Stop once this much data has been written.
+TARGET_BYTES = 300 * 1000 ** 3
+# Number of loader threads, and so the most batches that can be in flight
+MAX_IN_FLIGHT = 64
+# Number of batches allowed in flight at the start
+INITIAL_IN_FLIGHT = 4
+# Commits slower than this (in seconds) reduce the batches in flight.
+TARGET_LATENCY = 10.0
 
 # `100` is the bottom limit for reserved collections.
 COLL_ID = 100
@@ -75,105 +89,172 @@ PAYLOAD = ''.join(
     )
     for _ in range(PAYLOAD_SIZE))
 
+UC_COLUMNS = ('fxa_uid', 'fxa_kid', 'collection_id', 'modified')
+BSO_COLUMNS = (
+    'fxa_uid',
+    'fxa_kid',
+    'collection_id',
+    'bso_id',
+    'sortindex',
+    'payload',
+    'modified',
+    'expiry'
+)
+
+# Errors that mean spanner wants us to slow down.
+BACKOFF_ERRORS = (
+    Aborted, DeadlineExceeded, ResourceExhausted, ServiceUnavailable)
+
+
+class Throttle:
+    """AIMD (additive increase, multiplicative decrease) limit on the
+    number of batches in flight.
+
+    Every commit faster than TARGET_LATENCY raises the limit by about
+    one per round of commits. A slow or rejected commit halves it (at
+    most once per TARGET_LATENCY, so one burst of errors only counts
+    once).
+
+    """
+    def __init__(self, initial, maximum):
+        self.limit = float(initial)
+        self.maximum = maximum
+        self.in_flight = 0
+        self.last_decrease = 0
+        self.cond = threading.Condition()
+
+    def acquire(self):
+        with self.cond:
+            while self.in_flight >= int(self.limit):
+                self.cond.wait()
+            self.in_flight += 1
+
+    def release(self, latency=None, failed=False):
+        with self.cond:
+            self.in_flight -= 1
+            now = time.time()
+            if failed or latency > TARGET_LATENCY:
+                if now - self.last_decrease > TARGET_LATENCY:
+                    self.limit = max(1.0, self.limit / 2)
+                    self.last_decrease = now
+            else:
+                self.limit = min(
+                    self.maximum, self.limit + 1.0 / self.limit)
+            self.cond.notify_all()
+
+
+class Progress:
+    """Totals shared by all of the loader threads"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start = datetime.now()
+        self.batches = 0
+        self.records = 0
+        self.bytes = 0
+        # time spent building records vs. waiting on spanner.
+        self.build_seconds = 0.0
+        self.commit_seconds = 0.0
+
+    def add(self, records, size, build, commit):
+        with self.lock:
+            self.batches += 1
+            self.records += records
+            self.bytes += size
+            self.build_seconds += build
+            self.commit_seconds += commit
+            return self.batches
+
+    def done(self):
+        return self.bytes >= TARGET_BYTES
+
+
+def bso_ids(count):
+    """`count` random 32 character hex ids, from a single urandom call"""
+    raw = binascii.hexlify(os.urandom(16 * count)).decode('ascii')
+    return [raw[i:i + 32] for i in range(0, len(raw), 32)]
+
 
-def load(instance, db, coll_id, name):
-    fxa_uid = "DEADBEEF" + uuid.uuid4().hex[8:]
-    fxa_kid = "{:013d}-{}".format(22, fxa_uid)
-    print("{} -> Loading {} {}".format(name, fxa_uid, fxa_kid))
+def mutation_size(batch):
+    """the encoded size of the mutations queued in a batch"""
+    size = 0
+    for mutation in batch._mutations:
+        # proto-plus messages wrap the protobuf that is actually sent.
+        pb = getattr(type(mutation), 'pb', None)
+        size += (pb(mutation) if pb else mutation).ByteSize()
+    return size
+
+
+def load(db, coll_id, throttle, progress):
+    """write batches of records until TARGET_BYTES have been written.
+
+    Every batch belongs to a new user with a random fxa_uid, so writes
+    are spread across the key space rather than piling into the split
+    holding a single user.
+
+    """
     name = threading.current_thread().getName()
-    spanner_client = spanner.Client()
-    instance = spanner_client.instance(instance)
-    db = instance.database(db)
-    print('{name} Db: {db}'.format(name=name, db=db))
     start = datetime.now()
+    # Only the bso_id differs between the records of a user, so they
+    # are built from a fixed tail and a per user head.
+    tail = (None, PAYLOAD, start, start + timedelta(days=365 * 5))
+    while not progress.done():
+        build_start = time.time()
+        # Prefix uaids for easy filtering later
+        fxa_uid = "DEADBEEF" + uuid.uuid4().hex[8:]
+        fxa_kid = "{:013d}-{}".format(22, fxa_uid)
+        head = (fxa_uid, fxa_kid, coll_id)
+        records = [head + (bso_id,) + tail for bso_id in bso_ids(BATCH_SIZE)]
+        build = time.time() - build_start
 
-    def create_user(txn):
-        txn.execute_update(
-            """\
-            INSERT INTO user_collections
-                (fxa_uid, fxa_kid, collection_id, modified)
-            VALUES (@fxa_uid, @fxa_kid, @collection_id, @modified)
-            """,
-            params=dict(
-                fxa_uid=fxa_uid,
-                fxa_kid=fxa_kid,
-                collection_id=coll_id,
-                modified=start
-            ),
-            param_types=dict(
-                fxa_uid=param_types.STRING,
-                fxa_kid=param_types.STRING,
-                collection_id=param_types.INT64,
-                modified=param_types.TIMESTAMP
-            )
-        )
-
-    try:
-        db.run_in_transaction(create_user)
-        print('{name} Created user (fxa_uid: {uid}, fxa_kid: {kid})'.format(
-            name=name, uid=fxa_uid, kid=fxa_kid))
-    except AlreadyExists:
-        print('{name} Existing user (fxa_uid: {uid}}, fxa_kid: {kid}})'.format(
-              name=name, uid=fxa_uid, kid=fxa_kid))
-
-    # approximately 1892 bytes
-    rlen = 0
-
-    print('{name} Loading..'.format(name=name))
-    for j in range(BATCHES):
-        records = []
-        for i in range(BATCH_SIZE):
-            # create a record
-            record = (
-                fxa_uid,
-                fxa_kid,
-                coll_id,
-                str(uuid.uuid4()),
-                None,
-                PAYLOAD,
-                start,
-                start + timedelta(days=365 * 5)
-            )
-            # determine it's size.
-            rlen = len(record[1]) * 4
-            rlen += 64
-            rlen += len(record[3]) * 4
-            rlen += 64
-            rlen += len(record[5]) * 4
-            rlen += 64
-            rlen += 64
-            records.append(record)
-        with db.batch() as batch:
-            batch.insert(
-                table='bsos',
-                columns=(
-                    'fxa_uid',
-                    'fxa_kid',
-                    'collection_id',
-                    'bso_id',
-                    'sortindex',
-                    'payload',
-                    'modified',
-                    'expiry'
-                ),
-                values=records
-            )
+        throttle.acquire()
+        commit_start = time.time()
+        latency = None
+        try:
+            with db.batch() as batch:
+                # bsos are interleaved in user_collections
+                batch.insert(
+                    table='user_collections',
+                    columns=UC_COLUMNS,
+                    values=[(fxa_uid, fxa_kid, coll_id, start)]
+                )
+                batch.insert(
+                    table='bsos',
+                    columns=BSO_COLUMNS,
+                    values=records
+                )
+                size = mutation_size(batch)
+            latency = time.time() - commit_start
+        except BACKOFF_ERRORS as ex:
+            print('{name} Backing off: {ex}'.format(name=name, ex=ex))
+            continue
+        except AlreadyExists:
+            latency = time.time() - commit_start
+            print('{name} Existing user (fxa_uid: {uid}, '
+                  'fxa_kid: {kid})'.format(
+                      name=name, uid=fxa_uid, kid=fxa_kid))
+            continue
+        except Exception as ex:
+            print('{name} Stopping after error: {ex}'.format(
+                name=name, ex=ex))
+            return
+        finally:
+            # always give the slot back, or the other loaders would
+            # eventually block in acquire() forever.
+            throttle.release(latency, failed=latency is None)
+        batches = progress.add(BATCH_SIZE, size, build, latency)
         print(
-            ('{name} Wrote batch {b} of {bb}:'
-             ' {c} records {r} bytes, {t}').format(
+            ('{name} Wrote batch {b}:'
+             ' {c} records {r} bytes (built in {bl:.3f}s, committed in'
+             ' {l:.2f}s, {mb:.1f}MB/s), {f} in flight, {t}').format(
                 name=name,
-                b=j + 1,
-                bb=BATCHES,
+                b=batches,
                 c=BATCH_SIZE,
-                r=rlen,
-                t=datetime.now() - start))
-    print('{name} Total: {t} (count: {c}, size: {s} in {sec})'.format(
-        name=name,
-        t=BATCHES,
-        c=BATCHES * BATCH_SIZE,
-        s=BATCHES * BATCH_SIZE * rlen,
-        sec=datetime.now() - start
-    ))
+                r=size,
+                bl=build,
+                l=latency,
+                mb=size / max(latency, 0.001) / 1000000,
+                f=int(throttle.limit),
+                t=datetime.now() - progress.start))
 
 
 def from_env():
@@ -194,23 +275,35 @@ def from_env():
     return (instance_id, database_id)
 
 
-def loader():
-    # Prefix uaids for easy filtering later
-    # Each loader thread gets it's own fake user to prevent some hotspot
-    # issues.
-    (instance_id, database_id) = from_env()
-    # switching uid/kid to per load because of weird google trimming
-    name = threading.current_thread().getName()
-    load(instance_id, database_id, COLL_ID, name)
-
-
 def main():
-    for c in range(THREAD_COUNT):
-        print("Starting thread {}".format(c))
+    (instance_id, database_id) = from_env()
+    # One client, and a pool of sessions, shared by every loader thread.
+    spanner_client = spanner.Client()
+    instance = spanner_client.instance(instance_id)
+    db = instance.database(
+        database_id, pool=spanner.BurstyPool(target_size=MAX_IN_FLIGHT))
+    print('Db: {db}'.format(db=db))
+    throttle = Throttle(INITIAL_IN_FLIGHT, MAX_IN_FLIGHT)
+    progress = Progress()
+    threads = []
+    for c in range(MAX_IN_FLIGHT):
         t = threading.Thread(
             name="loader_{}".format(c),
-            target=loader)
+            target=load,
+            args=(db, COLL_ID, throttle, progress))
         t.start()
+        threads.append(t)
+    for t in threads:
+        t.join()
+    print(('Total: {t} (count: {c}, size: {s} in {sec}; {b:.1f}s building'
+           ' records, {w:.1f}s committing)').format(
+        t=progress.batches,
+        c=progress.records,
+        s=progress.bytes,
+        sec=datetime.now() - progress.start,
+        b=progress.build_seconds,
+        w=progress.commit_seconds
+    ))
 
 
 if __name__ == '__main__':
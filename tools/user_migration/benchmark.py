@@ -0,0 +1,261 @@
+#! venv/bin/python
+
+# Benchmark migrate_node.py without any live databases.
+#
+# A seeded SQLite file stands in for the MySQL bso{N} shards and a
+# fake_spanner.FakeDatabase for the spanner database. migrate_node is
+# run in process against both, and the rows/s, commits/s, peak RSS and
+# time spent reading and committing are reported, so throughput changes
+# can be measured before a production run. Any arguments that are not
+# listed by `--help` are passed through to migrate_node.py (e.g.
+# `--workers=4`).
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import argparse
+import json
+import logging
+import os
+import random
+import resource
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+import migrate_node
+from fake_spanner import FakeDatabase
+
+COLLECTIONS = (
+    "clients", "crypto", "forms", "history", "keys", "meta", "bookmarks",
+    "prefs", "tabs", "passwords", "addons", "addresses", "creditcards")
+
+
+class ReadStats:
+    """Time spent executing and fetching from the source database"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.seconds = 0.0
+        self.rows = 0
+
+    def add(self, seconds, rows):
+        with self.lock:
+            self.seconds += seconds
+            self.rows += rows
+
+
+class SQLiteCursor:
+    """MySQL flavoured cursor over sqlite3 (`%s` params, unix_timestamp())"""
+    def __init__(self, cursor, stats):
+        self.cursor = cursor
+        self.stats = stats
+
+    def timed(self, func, *args):
+        start = time.time()
+        result = func(*args)
+        rows = len(result) if isinstance(result, list) else 0
+        self.stats.add(time.time() - start, rows)
+        return result
+
+    def execute(self, sql, params=()):
+        sql = sql.replace("%s", "?").replace(
+            "unix_timestamp()", "CAST(strftime('%s', 'now') AS INTEGER)")
+        self.timed(self.cursor.execute, sql, params)
+
+    def fetchmany(self, size):
+        return self.timed(self.cursor.fetchmany, size)
+
+    def fetchall(self):
+        return self.timed(self.cursor.fetchall)
+
+    def fetchone(self):
+        return self.timed(self.cursor.fetchone)
+
+    def __iter__(self):
+        while True:
+            rows = self.fetchmany(100)
+            if not rows:
+                return
+            yield from rows
+
+    def close(self):
+        self.cursor.close()
+
+
+class SQLiteConnection:
+    def __init__(self, path, stats):
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.stats = stats
+
+    def cursor(self, buffered=None):
+        return SQLiteCursor(self.connection.cursor(), self.stats)
+
+    def close(self):
+        self.connection.close()
+
+
+def seed(path, token_file, args):
+    """write the bso{N} shards and token file, returns the row count"""
+    rand = random.Random(args.seed)
+    if os.path.exists(path):
+        os.remove(path)
+    db = sqlite3.connect(path)
+    db.execute("PRAGMA journal_mode=OFF")
+    db.execute("PRAGMA synchronous=OFF")
+    db.execute(
+        "CREATE TABLE collections (collectionid INTEGER, name TEXT)")
+    db.executemany(
+        "INSERT INTO collections VALUES (?, ?)",
+        [(cid, name) for (cid, name) in enumerate(COLLECTIONS, 1)])
+    db.execute(
+        "CREATE TABLE user_collections (userid INTEGER, collection INTEGER,"
+        " last_modified INTEGER)")
+    now = int(time.time())
+    rows = 0
+    with open(token_file, "w") as tokens:
+        tokens.write("uid\temail\tgeneration\tkeys_changed_at\t"
+                     "client_state\n")
+        for bso_num in range(args.shards):
+            db.execute(
+                "CREATE TABLE bso{} (userid INTEGER, collection INTEGER,"
+                " id TEXT, sortindex INTEGER, modified INTEGER,"
+                " payload TEXT, payload_size INTEGER, ttl INTEGER,"
+                " PRIMARY KEY (userid, collection, id))".format(bso_num))
+            for user in range(args.users):
+                uid = bso_num * args.users + user + 1
+                tokens.write("{}\t{:032x}@api.accounts.firefox.com\t{}\t\t"
+                             "{:032x}\n".format(uid, uid, uid, uid))
+                collections = rand.sample(
+                    range(1, len(COLLECTIONS) + 1), args.collections)
+                for cid in collections:
+                    db.execute(
+                        "INSERT INTO user_collections VALUES (?, ?, ?)",
+                        (uid, cid, now * 1000))
+                    count = rand.randint(1, args.bsos)
+                    db.executemany(
+                        "INSERT INTO bso{} VALUES (?, ?, ?, ?, ?, ?, ?, ?)"
+                        .format(bso_num),
+                        [(uid, cid, "{:012x}".format(bid), bid, now * 1000,
+                          "x" * rand.randint(1, args.payload * 2), 0,
+                          now + 86400)
+                         for bid in range(count)])
+                    rows += count
+    db.commit()
+    db.close()
+    return rows
+
+
+def get_args():
+    parser = argparse.ArgumentParser(
+        description="benchmark migrate_node.py against local fakes",
+        # so that migrate_node's arguments (e.g. --user) are passed on
+        # rather than taken as abbreviations of ours (--users).
+        allow_abbrev=False)
+    parser.add_argument(
+        '--shards', type=int, default=2,
+        help="number of bso{N} tables to seed")
+    parser.add_argument(
+        '--users', type=int, default=100,
+        help="users per bso table")
+    parser.add_argument(
+        '--collections', type=int, default=4,
+        help="collections per user")
+    parser.add_argument(
+        '--bsos', type=int, default=500,
+        help="maximum bsos per user collection")
+    parser.add_argument(
+        '--payload', type=int, default=1000,
+        help="mean payload size")
+    parser.add_argument(
+        '--seed', type=int, default=1,
+        help="random seed for the source data")
+    parser.add_argument(
+        '--latency', type=float, default=0.0,
+        help="seconds added to every spanner commit")
+    parser.add_argument(
+        '--keep_payloads', action="store_true",
+        help="keep payloads in the fake spanner (counts towards peak RSS)")
+    parser.add_argument(
+        '--workdir',
+        help="directory for the seeded files (default: a temp dir)")
+    parser.add_argument(
+        '--json', action="store_true",
+        help="print the report as JSON")
+    return parser.parse_known_args()
+
+
+def main():
+    (args, migrate_args) = get_args()
+    workdir = args.workdir or tempfile.mkdtemp(prefix="migrate_bench_")
+    os.makedirs(workdir, exist_ok=True)
+    source = os.path.join(workdir, "source.db")
+    token_file = os.path.join(workdir, "users.csv")
+    dsns = os.path.join(workdir, "dsns.lst")
+    with open(dsns, "w") as dsn_file:
+        dsn_file.write("mysql://bench@localhost/syncstorage\n")
+        dsn_file.write(
+            "spanner://projects/bench/instances/bench/databases/bench\n")
+
+    start = time.time()
+    expected = seed(source, token_file, args)
+    seed_seconds = time.time() - start
+
+    reads = ReadStats()
+    spanner = FakeDatabase(
+        latency=args.latency, keep_payloads=args.keep_payloads)
+    migrate_node.conf_mysql = lambda dsn: SQLiteConnection(source, reads)
+    migrate_node.conf_spanner = lambda dsn: spanner
+    sys.argv = [
+        "migrate_node.py",
+        "--dsns={}".format(dsns),
+        "--deanon",
+        "--fxa_file={}".format(token_file),
+        "--fxa_cache={}".format(os.path.join(workdir, "users.db")),
+        "--checkpoint={}".format(os.path.join(workdir, "journal.db")),
+        "--start_bso=0",
+        "--end_bso={}".format(args.shards - 1),
+        "--quiet",
+    ] + migrate_args
+    start = time.time()
+    migrate_node.main()
+    seconds = time.time() - start
+    logging.getLogger().setLevel(logging.INFO)
+
+    stats = spanner.stats
+    moved = len(spanner.tables["bsos"])
+    report = {
+        "rows": moved,
+        "expected_rows": expected,
+        "seconds": round(seconds, 3),
+        "rows_per_sec": round(moved / seconds, 1),
+        "commits": stats.commits,
+        "commits_per_sec": round(stats.commits / seconds, 1),
+        "rejected_commits": stats.rejected,
+        "mutations_per_commit": round(
+            stats.mutations / max(stats.commits, 1), 1),
+        "max_commit_mutations": stats.max_mutations,
+        "max_commit_bytes": stats.max_bytes,
+        "peak_rss_mb": round(
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "stage_seconds": {
+            "seed": round(seed_seconds, 3),
+            "mysql_read": round(reads.seconds, 3),
+            "spanner_commit": round(stats.commit_seconds, 3),
+        },
+        "workdir": workdir,
+    }
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        for (key, value) in report.items():
+            print("{:>22}: {}".format(key, value))
+    if moved != expected:
+        logging.error("Moved {} of {} rows".format(moved, expected))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
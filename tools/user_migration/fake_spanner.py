@@ -0,0 +1,301 @@
+# In-process stand in for a `google.cloud.spanner` Database.
+#
+# Only covers what the sync tools use: snapshot reads of whole tables,
+# run_in_transaction, batch, insert/update/replace/insert_or_update/delete
+# and a simple `DELETE ... WHERE expiry < CURRENT_TIMESTAMP()`
+# partitioned DML. Commits are charged mutations and bytes the way
+# spanner does, rejected when they exceed its limits and can be given
+# a fixed latency, so tool changes can be benchmarked without a GCP
+# instance.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import re
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+from google.api_core.exceptions import (
+    AlreadyExists, InvalidArgument, NotFound)
+
+MAX_MUTATIONS = 20000
+MAX_COMMIT_BYTES = 104857600
+
+# table => (primary key, interleaved parent, number of secondary indexes)
+# from spanner-2019-10-01.ddl
+TABLES = {
+    "collections": (("collection_id",), None, 1),
+    "user_collections": (
+        ("fxa_uid", "fxa_kid", "collection_id"), None, 0),
+    "bsos": (
+        ("fxa_uid", "fxa_kid", "collection_id", "bso_id"),
+        "user_collections", 2),
+    "batches": (
+        ("fxa_uid", "fxa_kid", "collection_id", "batch_id"),
+        "user_collections", 1),
+    "batch_bsos": (
+        ("fxa_uid", "fxa_kid", "collection_id", "batch_id", "batch_bso_id"),
+        "batches", 0),
+}
+INT64_SIZE = 8
+
+
+def value_size(value):
+    if isinstance(value, str):
+        return len(value.encode('utf-8'))
+    if isinstance(value, bytes):
+        return len(value)
+    return INT64_SIZE
+
+
+class Stats:
+    """Counters for everything committed to a FakeDatabase"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.commits = 0
+        self.mutations = 0
+        self.bytes = 0
+        self.rows = 0
+        self.commit_seconds = 0.0
+        self.rejected = 0
+        self.max_mutations = 0
+        self.max_bytes = 0
+
+    def reject(self):
+        with self.lock:
+            self.rejected += 1
+
+    def add(self, mutations, size, rows, seconds):
+        with self.lock:
+            self.commits += 1
+            self.mutations += mutations
+            self.bytes += size
+            self.rows += rows
+            self.commit_seconds += seconds
+            self.max_mutations = max(self.max_mutations, mutations)
+            self.max_bytes = max(self.max_bytes, size)
+
+
+class FakeResult:
+    def __init__(self, rows):
+        self.rows = rows
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def one(self):
+        if len(self.rows) != 1:
+            raise NotFound("expected one row, got {}".format(len(self.rows)))
+        return self.rows[0]
+
+
+class FakeSnapshot:
+    """Read only view. Only plain `SELECT cols FROM table` is supported."""
+    select = re.compile(
+        r"^\s*select\s+(.+?)\s+from\s+(\w+)\s*$", re.I | re.S)
+
+    def __init__(self, database):
+        self.database = database
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def execute_sql(self, sql, params=None, param_types=None):
+        match = self.select.match(sql)
+        if not match:
+            raise NotImplementedError("Unsupported query: {}".format(sql))
+        (columns, table) = match.groups()
+        if table not in self.database.tables:
+            raise NotFound("Table not found: {}".format(table))
+        with self.database.lock:
+            rows = list(self.database.tables[table].values())
+        if columns.strip() == "*":
+            return FakeResult([tuple(row.values()) for row in rows])
+        names = [name.strip() for name in columns.split(",")]
+        return FakeResult(
+            [tuple(row.get(name) for name in names) for row in rows])
+
+
+class FakeTransaction:
+    """Buffers mutations until commit, like spanner's Transaction/Batch"""
+    def __init__(self, database):
+        self.database = database
+        self.mutations = []
+
+    def _mutate(self, operation, table, columns, values):
+        if table not in TABLES:
+            raise NotFound("Table not found: {}".format(table))
+        self.mutations.append((operation, table, tuple(columns), values))
+
+    def insert(self, table, columns, values):
+        self._mutate("insert", table, columns, values)
+
+    def update(self, table, columns, values):
+        self._mutate("update", table, columns, values)
+
+    def insert_or_update(self, table, columns, values):
+        self._mutate("insert_or_update", table, columns, values)
+
+    def replace(self, table, columns, values):
+        self._mutate("replace", table, columns, values)
+
+    def delete(self, table, keyset):
+        self._mutate("delete", table, (), [tuple(key) for key in keyset.keys])
+
+    def commit(self):
+        self.database.commit(self.mutations)
+
+
+class FakeDatabase:
+    """A single spanner database held in memory.
+
+    With `keep_payloads=False` payloads are dropped once committed, so
+    that the fake's own memory use doesn't swamp the tool's.
+    """
+    def __init__(self, latency=0.0, max_mutations=MAX_MUTATIONS,
+                 max_bytes=MAX_COMMIT_BYTES, keep_payloads=True):
+        self.latency = latency
+        self.keep_payloads = keep_payloads
+        self.max_mutations = max_mutations
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.tables = dict((table, {}) for table in TABLES)
+        self.stats = Stats()
+
+    def snapshot(self, **kwargs):
+        return FakeSnapshot(self)
+
+    def run_in_transaction(self, func, *args, **kwargs):
+        transaction = FakeTransaction(self)
+        result = func(transaction, *args, **kwargs)
+        transaction.commit()
+        return result
+
+    @contextmanager
+    def batch(self):
+        batch = FakeTransaction(self)
+        yield batch
+        batch.commit()
+
+    def cost(self, mutations):
+        """the (mutations, bytes, rows) spanner would charge a commit"""
+        count = 0
+        size = 0
+        rows = 0
+        for (operation, table, columns, values) in mutations:
+            (key, parent, indexes) = TABLES[table]
+            for row in values:
+                rows += 1
+                if operation == "delete":
+                    count += 1
+                    size += sum(value_size(value) for value in row)
+                    continue
+                count += len(columns) + indexes
+                row_size = sum(value_size(value) for value in row)
+                # each index entry repeats (about) the whole row key.
+                key_size = sum(
+                    value_size(value) for (column, value)
+                    in zip(columns, row) if column in key)
+                size += row_size + indexes * (key_size + INT64_SIZE)
+        return (count, size, rows)
+
+    def commit(self, mutations):
+        start = time.time()
+        (count, size, rows) = self.cost(mutations)
+        if count > self.max_mutations:
+            self.stats.reject()
+            raise InvalidArgument(
+                "The transaction contains too many mutations. "
+                "(Maximum number: {}, was {})".format(
+                    self.max_mutations, count))
+        if size > self.max_bytes:
+            self.stats.reject()
+            raise InvalidArgument(
+                "The transaction exceeds the maximum total bytes-size "
+                "that can be handled by Spanner. (Maximum size: {}, "
+                "was {})".format(self.max_bytes, size))
+        if self.latency:
+            time.sleep(self.latency)
+        with self.lock:
+            self.apply(mutations)
+        self.stats.add(count, size, rows, time.time() - start)
+
+    def apply(self, mutations):
+        # check the whole commit before changing anything.
+        staged = []
+        pending = set()
+        for (operation, table, columns, values) in mutations:
+            (key, parent, indexes) = TABLES[table]
+            rows = self.tables[table]
+            for row in values:
+                if operation == "delete":
+                    staged.append((table, tuple(row), None))
+                    continue
+                record = dict(zip(columns, row))
+                row_key = tuple(record[column] for column in key)
+                exists = row_key in rows or (table, row_key) in pending
+                if operation == "insert" and exists:
+                    raise AlreadyExists(
+                        "Row {} in table {} already exists".format(
+                            row_key, table))
+                if operation == "update" and not exists:
+                    raise NotFound(
+                        "Row {} in table {} is missing".format(
+                            row_key, table))
+                if parent:
+                    parent_key = row_key[:len(TABLES[parent][0])]
+                    if (parent_key not in self.tables[parent] and
+                            (parent, parent_key) not in pending):
+                        raise NotFound(
+                            "Parent row for row {} in table {} is "
+                            "missing".format(row_key, table))
+                if operation in ("update", "insert_or_update") and exists:
+                    merged = dict(rows.get(row_key, {}))
+                    merged.update(record)
+                    record = merged
+                if not self.keep_payloads:
+                    record.pop("payload", None)
+                pending.add((table, row_key))
+                staged.append((table, row_key, record))
+        for (table, row_key, record) in staged:
+            if record is None:
+                self.delete_rows(table, [row_key])
+            else:
+                self.tables[table][row_key] = record
+
+    def delete_rows(self, table, row_keys):
+        """delete rows along with their interleaved children"""
+        rows = self.tables[table]
+        for row_key in row_keys:
+            rows.pop(row_key, None)
+        width = len(TABLES[table][0])
+        doomed = set(row_keys)
+        for (child, (key, parent, indexes)) in TABLES.items():
+            if parent != table:
+                continue
+            children = [
+                child_key for child_key in self.tables[child]
+                if child_key[:width] in doomed]
+            self.delete_rows(child, children)
+
+    def execute_partitioned_dml(self, dml, params=None, param_types=None):
+        """Only `DELETE FROM table WHERE expiry < CURRENT_TIMESTAMP()`"""
+        match = re.match(
+            r"^\s*delete\s+from\s+(\w+)\s+where\s+expiry\s*<\s*"
+            r"current_timestamp\(\)\s*$", dml, re.I)
+        if not match:
+            raise NotImplementedError("Unsupported DML: {}".format(dml))
+        table = match.group(1)
+        now = datetime.utcnow()
+        with self.lock:
+            expired = [
+                row_key for (row_key, row) in self.tables[table].items()
+                if row["expiry"] < now]
+            self.delete_rows(table, expired)
+        return len(expired)
@@ -15,52 +15,121 @@ import sys
 import math
 import json
 import os
+import queue
+import sqlite3
+import threading
 import time
+from concurrent.futures import (
+    ThreadPoolExecutor, FIRST_COMPLETED, as_completed, wait)
 from datetime import datetime
 
 from mysql import connector
 from google.cloud import spanner
 from google.api_core.exceptions import AlreadyExists, InvalidArgument
 try:
-    from urllib.parse import urlparse
+    from urllib.parse import quote, urlparse
 except ImportError:
+    from urllib import quote
     from urlparse import urlparse
 
 META_GLOBAL_COLLECTION_ID = 6
 MAX_ROWS = 1500000
 
+# Spanner per commit limits (see tools/spanner/write_batch.py).
+# Every column written counts as a mutation, as does every index entry.
+MAX_MUTATIONS = 20000
+MAX_COMMIT_BYTES = 104857600
+# Leave some room for the encoding overhead not counted by our estimate.
+COMMIT_HEADROOM = 0.9
+# Each packed commit is held in memory, along with the `--prefetch`
+# commits read ahead of it, so their size is capped well below the limit.
+MAX_BATCH_BYTES = 16 * 1024 * 1024
+# Every bsos row also writes an entry in each of these indexes.
+BSO_INDEXES = ("BsoModified", "BsoExpiry")
+INT64_SIZE = 8
+# How many userids to fetch per page when listing a bso table's users.
+USER_PAGE_SIZE = 1000
+# Seconds to wait for another process's lock on a shared journal.
+JOURNAL_TIMEOUT = 60
+
 
 class BadDSNException(Exception):
     pass
 
 
+class CheckpointError(Exception):
+    pass
+
+
 class FXA_info:
     """User information from Tokenserver database.
 
     Can be constructed from
     ``mysql -e "select uid, email, generation, keys_changed_at, \
        client_state from users;" > users.csv`
+
+    The token file is compiled once into an indexed sqlite lookup file
+    (`--fxa_cache`), which is then queried per user. This avoids
+    parsing the whole token file into memory in every process.
+
+    Without a cache, only the users being moved are read from the
+    token file, once their userids are known (see `load`).
     """
     users = {}
     anon = False
+    cache_file = None
+    fxa_csv_file = None
 
     def __init__(self, fxa_csv_file, args):
+        if args.compile_fxa:
+            self.compile(fxa_csv_file, args.fxa_cache)
+            return
         if args.anon:
             self.anon = True
             return
+        if args.fxa_cache:
+            if not self.is_fresh(fxa_csv_file, args.fxa_cache):
+                self.compile(fxa_csv_file, args.fxa_cache)
+            self.cache_file = args.fxa_cache
+            self.local = threading.local()
+            return
+        if not os.path.isfile(fxa_csv_file):
+            raise IOError("{} not found".format(fxa_csv_file))
+        self.fxa_csv_file = fxa_csv_file
+
+    def load(self, uids):
+        """read the token file entries for just the given userids"""
         logging.debug("Processing token file...")
+        start = time.time()
+        for (uid, fxa_kid, fxa_uid) in self.read_csv(
+                self.fxa_csv_file, set(uids)):
+            self.users[uid] = (fxa_kid, fxa_uid)
+        logging.info("Loaded {} of {} users in {} seconds".format(
+            len(self.users), len(uids), math.ceil(time.time() - start)))
+
+    def read_csv(self, fxa_csv_file, only=None):
+        """yield (uid, fxa_kid, fxa_uid) for the users in the token file,
+        optionally only those in `only`"""
         if not os.path.isfile(fxa_csv_file):
             raise IOError("{} not found".format(fxa_csv_file))
+
+        def wanted(lines):
+            # Check the leading uid before any of the line is decoded.
+            for text in lines:
+                uid = text.split("\t", 1)[0]
+                if uid.isdigit() and int(uid) in only:
+                    yield text
+
         with open(fxa_csv_file) as csv_file:
             try:
                 line = 0
+                lines = csv_file
+                if only is not None:
+                    lines = wanted(csv_file)
                 for (uid, email, generation,
                      keys_changed_at, client_state) in csv.reader(
-                        csv_file, delimiter="\t"):
+                        lines, delimiter="\t"):
                     line += 1
-                    if args.user:
-                        if int(uid) not in args.user:
-                            continue
                     if uid == 'uid':
                         # skip the header row.
                         continue
@@ -72,13 +141,68 @@ class FXA_info:
                         logging.debug("Adding user {} => {} , {}".format(
                             uid, fxa_kid, fxa_uid
                         ))
-                        self.users[int(uid)] = (fxa_kid, fxa_uid)
+                        yield (int(uid), fxa_kid, fxa_uid)
                     except Exception as ex:
                         logging.error("Skipping user {}:".format(uid), ex)
             except Exception as ex:
                 logging.critical("Error in fxa file around line {}: {}".format(
                     line, ex))
 
+    def is_fresh(self, fxa_csv_file, cache_file):
+        """is the compiled cache at least as new as the token file"""
+        if not os.path.isfile(cache_file):
+            return False
+        if not os.path.isfile(fxa_csv_file):
+            return True
+        return os.path.getmtime(cache_file) >= os.path.getmtime(fxa_csv_file)
+
+    def compile(self, fxa_csv_file, cache_file):
+        """compile the token file into a sqlite file keyed by uid"""
+        logging.info("Compiling {} into {}...".format(
+            fxa_csv_file, cache_file))
+        start = time.time()
+        # Build aside and move into place, so that concurrent migrators
+        # never see a partial file.
+        tmp_file = "{}.{}".format(cache_file, os.getpid())
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        conn = sqlite3.connect(tmp_file)
+        try:
+            conn.execute("PRAGMA journal_mode=OFF")
+            conn.execute("PRAGMA synchronous=OFF")
+            conn.execute("""
+                CREATE TABLE users (
+                    uid INTEGER PRIMARY KEY,
+                    fxa_kid TEXT NOT NULL,
+                    fxa_uid TEXT NOT NULL
+                )""")
+            conn.executemany(
+                "INSERT OR REPLACE INTO users VALUES (?, ?, ?)",
+                self.read_csv(fxa_csv_file))
+            conn.commit()
+            count = conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+        finally:
+            conn.close()
+        os.replace(tmp_file, cache_file)
+        logging.info("Compiled {} users in {} seconds".format(
+            count, math.ceil(time.time() - start)))
+
+    def lookup(self, userid):
+        """read a user from the compiled cache (one connection per
+        thread, shared between processes via the page cache)"""
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(
+                "file:{}?mode=ro".format(
+                    quote(os.path.abspath(self.cache_file))),
+                uri=True)
+            self.local.conn = conn
+        row = conn.execute(
+            "SELECT fxa_kid, fxa_uid FROM users WHERE uid = ?",
+            (userid,)).fetchone()
+        if row:
+            return tuple(row)
+
     # The following two functions are taken from browserid.utils
     def encode_bytes_b64(self, value):
         return base64.urlsafe_b64encode(value).rstrip(b'=').decode('ascii')
@@ -92,6 +216,8 @@ class FXA_info:
     def get(self, userid):
         if userid in self.users:
             return self.users[userid]
+        if self.cache_file:
+            return self.lookup(userid)
         if self.anon:
             fxa_uid = "fake_" + binascii.hexlify(
                 os.urandom(11)).decode('utf-8')
@@ -193,6 +319,122 @@ class Collections:
         return id
 
 
+class BatchPacker:
+    """Pack bso rows into commits that fit within spanner's limits.
+
+    Rather than a fixed number of rows per commit, each row is charged
+    the mutations and bytes it will cost (including its index entries)
+    and a commit is closed once either budget would be exceeded.
+
+    """
+    def __init__(self, columns, indexes=BSO_INDEXES,
+                 max_mutations=MAX_MUTATIONS,
+                 max_bytes=MAX_COMMIT_BYTES,
+                 headroom=COMMIT_HEADROOM):
+        self.row_mutations = columns + len(indexes)
+        self.indexes = len(indexes)
+        self.max_mutations = int(max_mutations * headroom)
+        self.max_bytes = int(max_bytes * headroom)
+
+    def row_size(self, row, key_size):
+        """estimate the commit bytes for a
+        (col, cid, bid, exp, mod, pay, sid) row"""
+        key = key_size + INT64_SIZE + len(row[2])
+        # key, expiry, modified, payload & sortindex
+        size = key + 3 * INT64_SIZE + len(row[5])
+        # each index entry is the key plus the indexed timestamp
+        return size + self.indexes * (key + INT64_SIZE)
+
+    def pack(self, rows, key_size):
+        """yield lists of rows that each fit in a single commit.
+
+        `key_size` is the length of the fxa_uid and fxa_kid shared by
+        every row of the user.
+
+        """
+        batch = []
+        mutations = 0
+        size = 0
+        for row in rows:
+            row_size = self.row_size(row, key_size)
+            if batch and (
+                    mutations + self.row_mutations > self.max_mutations or
+                    size + row_size > self.max_bytes):
+                yield batch
+                batch = []
+                mutations = 0
+                size = 0
+            batch.append(row)
+            mutations += self.row_mutations
+            size += row_size
+        if batch:
+            yield batch
+
+
+class Checkpoint:
+    """Local, append only journal of the migration's progress.
+
+    An entry is appended after every committed chunk of BSOs
+    (bso_num, userid, rows so far, last mysql collection & bso id) and
+    once the user is finished, so that `--resume` can skip finished
+    users and continue a partially moved user after its last chunk.
+
+    """
+    def __init__(self, path, timeout=JOURNAL_TIMEOUT):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(
+            path, timeout=timeout, check_same_thread=False,
+            isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS journal (
+                bso_num INTEGER NOT NULL,
+                userid INTEGER NOT NULL,
+                rows INTEGER NOT NULL,
+                collection INTEGER,
+                bso_id TEXT,
+                done INTEGER NOT NULL,
+                stamp REAL NOT NULL
+            )""")
+        self.conn.execute("""
+            CREATE INDEX IF NOT EXISTS journal_user
+                ON journal (bso_num, userid)""")
+
+    def record(self, bso_num, userid, rows,
+               collection=None, bso_id=None, done=False):
+        with self.lock:
+            try:
+                self.conn.execute(
+                    "INSERT INTO journal VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (bso_num, userid, rows, collection, bso_id, int(done),
+                     time.time()))
+            except sqlite3.Error as ex:
+                raise CheckpointError(
+                    "Could not journal bso{} user {}: {}".format(
+                        bso_num, userid, ex)) from ex
+
+    def finished(self, bso_num):
+        """the set of userids in bso{bso_num} that were completely moved"""
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT DISTINCT userid FROM journal"
+                " WHERE bso_num = ? AND done",
+                (bso_num,))
+            return set(userid for (userid,) in rows)
+
+    def progress(self, bso_num, userid):
+        """the latest (rows, collection, bso_id, done) entry for a user"""
+        with self.lock:
+            return self.conn.execute(
+                "SELECT rows, collection, bso_id, done FROM journal"
+                " WHERE bso_num = ? AND userid = ?"
+                " ORDER BY rowid DESC LIMIT 1",
+                (bso_num, userid)).fetchone()
+
+    def close(self):
+        self.conn.close()
+
+
 def conf_mysql(dsn):
     """create a connection to the original storage system """
     logging.debug("Configuring MYSQL: {}".format(dsn))
@@ -230,6 +472,18 @@ def conf_db(dsn):
     raise RuntimeError("Unknown DSN type: {}".format(dsn.scheme))
 
 
+def conf_databases(dsns):
+    """create a connection for each of the mysql and spanner DSNs"""
+    databases = {}
+    for line in dsns:
+        dsn = urlparse(line.strip())
+        scheme = dsn.scheme
+        if 'mysql' in dsn.scheme:
+            scheme = 'mysql'
+        databases[scheme] = conf_db(dsn)
+    return databases
+
+
 def dumper(columns, values):
     """verbose column and data dumper. """
     result = ""
@@ -256,17 +510,75 @@ def alter_syncids(pay):
     return json.dumps(payload)
 
 
-def divvy(biglist, count):
-    lists = []
-    biglen = len(biglist)
-    start = 0
-    while start < biglen:
-        lists.append(biglist[start:min(start+count, biglen)])
-        start += count
-    return lists
+def read_chunks(cursor, count):
+    """yield the rows of an executed, unbuffered cursor `count` at a time.
+
+    Rows are pulled from the server as they are consumed, so only one
+    chunk is held in memory regardless of the size of the result set.
+
+    """
+    while True:
+        rows = cursor.fetchmany(count)
+        if not rows:
+            return
+        yield rows
+
+
+def prefetch(iterable, depth):
+    """iterate over `iterable` from a background thread, reading up to
+    `depth` items ahead of the consumer.
+
+    This lets the (mysql) reads behind `iterable` run while the consumer
+    is busy (writing to spanner). The bounded queue keeps the reader
+    from running further ahead than that.
+
+    """
+    if depth < 1:
+        yield from iterable
+        return
+    items = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+    done = object()
+
+    def put(entry):
+        # give up if the consumer has gone away.
+        while not stop.is_set():
+            try:
+                items.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+            put((done, None))
+        except Exception as ex:
+            put((done, ex))
+
+    reader = threading.Thread(
+        target=produce,
+        name="{}_reader".format(threading.current_thread().name),
+        daemon=True)
+    reader.start()
+    try:
+        while True:
+            (item, error) = items.get()
+            if item is done:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        stop.set()
+        reader.join()
 
 
-def move_user(databases, user_data, collections, fxa, bso_num, args):
+def move_user(databases, user_data, collections, fxa, bso_num, args,
+              checkpoint=None):
     """copy user info from original storage to new storage."""
     # bso column mapping:
     # id => bso_id
@@ -295,6 +607,24 @@ def move_user(databases, user_data, collections, fxa, bso_num, args):
     )
 
     (user, fxa_kid, fxa_uid) = user_data
+    # Pick up after the last chunk committed by a previous run.
+    moved = 0
+    resume_filter = ""
+    params = (user,)
+    progress = None
+    if checkpoint and args.resume:
+        progress = checkpoint.progress(bso_num, user)
+    if progress:
+        (moved, last_col, last_id, done) = progress
+        if done:
+            logging.info("Skipping already moved user {}".format(user))
+            return 0
+        logging.info("Resuming user {} after {} rows ({}:{})".format(
+            user, moved, last_col, last_id))
+        resume_filter = """
+            and (bso.collection > %s
+                 or (bso.collection = %s and bso.id > %s))"""
+        params = (user, last_col, last_col, last_id)
     # Fetch the BSO data from the original storage.
     sql = """
     SELECT
@@ -307,48 +637,68 @@ def move_user(databases, user_data, collections, fxa, bso_num, args):
         bso.userid = %s
             and collections.collectionid = bso.collection
             and bso.ttl > unix_timestamp()
+            {}
     ORDER BY
-        bso.collection, bso.id""".format(bso_num)
+        bso.collection, bso.id""".format(bso_num, resume_filter)
+    # The user_collections rows for the BSOs above, with the most recent
+    # modified time of each collection.
+    uc_sql = """
+    SELECT
+        collections.name, bso.collection, MAX(bso.modified)
+    FROM
+        bso{} as bso,
+        collections
+    WHERE
+        bso.userid = %s
+            and collections.collectionid = bso.collection
+            and bso.ttl > unix_timestamp()
+    GROUP BY
+        bso.collection, collections.name""".format(bso_num)
+
+    # Only format the per row debug output if it will be logged.
+    debug = logging.getLogger().isEnabledFor(logging.DEBUG)
 
     def spanner_transact_uc(
             transaction, data, fxa_kid, fxa_uid, args):
         # user collections require a unique key.
         unique_key_filter = set()
-        for (col, cid, bid, exp, mod, pay, sid) in data:
+        uc_values = []
+        for (col, cid, mod) in data:
             collection_id = collections.get(col, cid)
             if collection_id is None:
                 continue
-            # columns from sync_schema3
-            mod_v = datetime.utcfromtimestamp(mod/1000.0)
             # User_Collection can only have unique values. Filter
-            # non-unique keys and take the most recent modified
-            # time. The join could be anything.
-            uc_key = "{}_{}_{}".format(fxa_uid, fxa_kid, col)
-            if uc_key not in unique_key_filter:
-                uc_values = [(
+            # non-unique keys (the query already takes the most
+            # recent modified time per collection).
+            if collection_id not in unique_key_filter:
+                # columns from sync_schema3
+                mod_v = datetime.utcfromtimestamp(mod/1000.0)
+                uc_values.append((
                     fxa_kid,
                     fxa_uid,
                     collection_id,
                     mod_v,
-                )]
-                if not args.dryrun:
-                    transaction.replace(
-                        'user_collections',
-                        columns=uc_columns,
-                        values=uc_values
-                    )
-                else:
-                    logging.debug("not writing {} => {}".format(
-                        uc_columns, uc_values))
-                unique_key_filter.add(uc_key)
+                ))
+                unique_key_filter.add(collection_id)
+        if not uc_values:
+            return
+        if not args.dryrun:
+            transaction.replace(
+                'user_collections',
+                columns=uc_columns,
+                values=uc_values
+            )
+        elif debug:
+            logging.debug("not writing {} => {}".format(
+                uc_columns, uc_values))
 
     def spanner_transact_bso(transaction, data, fxa_kid, fxa_uid, args):
-        count = 0
+        bso_values = []
         for (col, cid, bid, exp, mod, pay, sid) in data:
             collection_id = collections.get(col, cid)
             if collection_id is None:
                 continue
-            if collection_id != cid:
+            if debug and collection_id != cid:
                 logging.debug(
                     "Remapping collection '{}' from {} to {}".format(
                         col, cid, collection_id))
@@ -359,7 +709,7 @@ def move_user(databases, user_data, collections, fxa, bso_num, args):
             # add the BSO values.
             if args.full and collection_id == META_GLOBAL_COLLECTION_ID:
                 pay = alter_syncids(pay)
-            bso_values = [[
+            bso_values.append((
                     collection_id,
                     fxa_kid,
                     fxa_uid,
@@ -368,34 +718,57 @@ def move_user(databases, user_data, collections, fxa, bso_num, args):
                     mod_v,
                     pay,
                     sid,
-            ]]
+            ))
 
-            if not args.dryrun:
+        if not bso_values:
+            return 0
+        # Write the whole chunk as a single mutation.
+        if not args.dryrun:
+            if debug:
                 logging.debug(
                     "###bso{} {}".format(
                         bso_num,
                         dumper(bso_columns, bso_values)
                     )
                 )
-                transaction.insert(
-                    'bsos',
-                    columns=bso_columns,
-                    values=bso_values
-                )
-            else:
-                logging.debug("not writing {} => {}".format(
-                    bso_columns, bso_values))
-            count += 1
-        return count
+            # A previous run may have committed chunks after the last
+            # one it journaled, so a resumed run overwrites rather than
+            # failing with AlreadyExists (and marking the user done).
+            write = transaction.insert
+            if checkpoint and args.resume:
+                write = transaction.insert_or_update
+            write(
+                'bsos',
+                columns=bso_columns,
+                values=bso_values
+            )
+        elif debug:
+            logging.debug("not writing {} => {}".format(
+                bso_columns, bso_values))
+        return len(bso_values)
 
-    cursor = databases['mysql'].cursor()
+    # Stream the rows rather than buffering the whole result set.
+    cursor = databases['mysql'].cursor(buffered=False)
     count = 0
+    bunches = None
     try:
         # Note: cursor() does not support __enter__()
         logging.info("Processing... {} -> {}:{}".format(
             user, fxa_uid, fxa_kid))
-        cursor.execute(sql, (user,))
-        data = []
+        # BSOs are interleaved in their user_collections row, so write
+        # all of the user's user_collections first, in one commit.
+        # Each chunk of BSOs then only needs a single commit.
+        cursor.execute(uc_sql, (user,))
+        uc_data = cursor.fetchall()
+        if uc_data:
+            databases['spanner'].run_in_transaction(
+                spanner_transact_uc,
+                uc_data,
+                fxa_kid,
+                fxa_uid,
+                args,
+            )
+        cursor.execute(sql, params)
         abort_col = None
         abort_count = None
         col_count = 0
@@ -403,32 +776,31 @@ def move_user(databases, user_data, collections, fxa, bso_num, args):
         if args.abort:
             (abort_col, abort_count) = args.abort.split(":")
             abort_count = int(abort_count)
-        for row in cursor:
-            logging.debug("col: {}".format(row[0]))
-            if abort_col and int(row[1]) == int(abort_col):
-                col_count += 1
-                if col_count > abort_count:
-                    logging.debug("Skipping col: {}: {} of {}".format(
-                        row[0], col_count, abort_count))
-                    continue
-            data.append(row)
-        if args.abort:
-            logging.info("Skipped {} of {} rows for {}".format(
-                abort_count, col_count, abort_col
-            ))
-        for bunch in divvy(data, args.readchunk or 1000):
-            # Occasionally, there is a batch fail because a
-            # user collection is not found before a bso is written.
-            # to solve that, divide the UC updates from the
-            # BSO updates.
-            # Run through the list of UserCollection updates
-            databases['spanner'].run_in_transaction(
-                spanner_transact_uc,
-                bunch,
-                fxa_kid,
-                fxa_uid,
-                args,
-            )
+
+        def read_rows():
+            nonlocal col_count
+            for chunk in read_chunks(cursor, args.readchunk or 1000):
+                for row in chunk:
+                    if debug:
+                        logging.debug("col: {}".format(row[0]))
+                    if abort_col and int(row[1]) == int(abort_col):
+                        col_count += 1
+                        if col_count > abort_count:
+                            logging.debug(
+                                "Skipping col: {}: {} of {}".format(
+                                    row[0], col_count, abort_count))
+                            continue
+                    yield row
+
+        packer = BatchPacker(
+            columns=len(bso_columns),
+            max_mutations=args.max_mutations,
+            max_bytes=min(args.max_commit_bytes, args.max_batch_bytes))
+        # Read and pack the next chunks while the current one is written.
+        bunches = prefetch(
+            packer.pack(read_rows(), len(fxa_uid) + len(fxa_kid)),
+            args.prefetch)
+        for bunch in bunches:
             count += databases['spanner'].run_in_transaction(
                 spanner_transact_bso,
                 bunch,
@@ -436,24 +808,44 @@ def move_user(databases, user_data, collections, fxa, bso_num, args):
                 fxa_uid,
                 args,
             )
+            if checkpoint:
+                checkpoint.record(
+                    bso_num, user, moved + count, bunch[-1][1], bunch[-1][2])
+        if args.abort:
+            logging.info("Skipped {} of {} rows for {}".format(
+                abort_count, col_count, abort_col
+            ))
+        if checkpoint:
+            checkpoint.record(bso_num, user, moved + count, done=True)
 
     except AlreadyExists:
         logging.warn(
             "User already imported fxa_uid:{} / fxa_kid:{}".format(
                 fxa_uid, fxa_kid
             ))
+        if checkpoint:
+            checkpoint.record(bso_num, user, moved + count, done=True)
     except InvalidArgument as ex:
         if "already inserted" in ex.args[0]:
             logging.warn(
                 "User already imported fxa_uid:{} / fxa_kid:{}".format(
                     fxa_uid, fxa_kid
                 ))
+            if checkpoint:
+                checkpoint.record(bso_num, user, moved + count, done=True)
         else:
             raise
+    except CheckpointError:
+        # The commits went through but can no longer be journaled, so
+        # stop rather than report the user's data as failed.
+        raise
     except Exception as e:
         logging.error("### batch failure: {}:{}".format(
             fxa_uid, fxa_kid), exc_info=e)
     finally:
+        if bunches is not None:
+            # stop the reader before touching the cursor.
+            bunches.close()
         # cursor may complain about unread data, this should prevent
         # that warning.
         for result in cursor:
@@ -462,63 +854,155 @@ def move_user(databases, user_data, collections, fxa, bso_num, args):
     return count
 
 
-def get_users(args, databases, fxa, bso_num):
-    users = []
-    cursor = databases['mysql'].cursor()
+def get_user_ids(args, databases, bso_num):
+    """yield the distinct userids found in bso{bso_num} (or given by --user)
+
+    Users are fetched a page at a time starting after the last userid
+    seen, so every page is a short index range scan and the first users
+    can be moved before the rest have been listed.
+
+    """
     if args.user:
-        users = args.user
-    else:
+        yield from args.user
+        return
+    (start, end) = ("", "")
+    if args.user_range:
+        (start, end) = args.user_range.split(':')
+    last = int(start) - 1 if start else -1
+    sql = """select distinct userid from bso{} where userid > %s""".format(
+        bso_num)
+    if end:
+        sql += " and userid < {}".format(int(end))
+    sql += " order by userid limit {}".format(USER_PAGE_SIZE)
+    while True:
+        cursor = databases['mysql'].cursor()
         try:
-            sql = ("""select distinct userid from bso{}"""
-                   """ order by userid""".format(bso_num))
-            if args.user_range:
-                (offset, limit) = args.user_range.split(':')
-                sql = "{} limit {} offset {}".format(
-                    sql, limit, offset)
-            cursor.execute(sql)
-            for (user,) in cursor:
-                try:
-                    (fxa_kid, fxa_uid) = fxa.get(user)
-                    users.append((user, fxa_kid, fxa_uid))
-                except TypeError:
-                    logging.error(
-                        ("⚠️User not found in"
-                         "tokenserver data: {} ".format(user)))
-            if args.sort_users:
-                users.sort(key=lambda tup: tup[2])
+            cursor.execute(sql, (last,))
+            page = [user for (user,) in cursor]
         except Exception as ex:
-            import pdb; pdb.set_trace()
-            logging.error("Error moving database:", exc_info=ex)
+            # returning would report the shard as finished, minus the
+            # users not yet listed.
+            logging.error("Error listing users after {}:".format(last),
+                          exc_info=ex)
+            raise
         finally:
             cursor.close()
-    return users
+        yield from page
+        if len(page) < USER_PAGE_SIZE:
+            return
+        last = page[-1]
 
 
-def move_database(databases, collections, bso_num, fxa, args):
+def get_users(args, databases, fxa, bso_num):
+    """yield the (userid, fxa_kid, fxa_uid) of each user to move"""
+    def users():
+        for user in get_user_ids(args, databases, bso_num):
+            try:
+                (fxa_kid, fxa_uid) = fxa.get(user)
+                yield (user, fxa_kid, fxa_uid)
+            except TypeError:
+                logging.error(
+                    ("⚠️User not found in"
+                     "tokenserver data: {} ".format(user)))
+
+    if args.sort_users:
+        # Sorting needs every user to be listed before any are moved.
+        return sorted(users(), key=lambda tup: tup[2])
+    return users()
+
+
+def move_users_parallel(users, collections, fxa, bso_num, args,
+                        checkpoint=None):
+    """move users using a pool of `args.workers` threads.
+
+    Each worker thread opens its own mysql connection and spanner
+    session pool, so users are moved fully independently of each other.
+
+    """
+    local = threading.local()
+    opened = []
+    lock = threading.Lock()
+
+    def connect():
+        local.databases = conf_databases(args.dsn_lines)
+        with lock:
+            opened.append(local.databases)
+
+    def move(user):
+        return move_user(
+            databases=local.databases,
+            user_data=user,
+            collections=collections,
+            fxa=fxa,
+            bso_num=bso_num,
+            args=args,
+            checkpoint=checkpoint)
+
+    rows = 0
+    count = 0
+    try:
+        with ThreadPoolExecutor(
+                max_workers=args.workers,
+                thread_name_prefix="bso{}".format(bso_num),
+                initializer=connect) as pool:
+            # Only keep a couple of users queued per worker.
+            pending = set()
+            for user in users:
+                if len(pending) >= args.workers * 2:
+                    (done, pending) = wait(
+                        pending, return_when=FIRST_COMPLETED)
+                    rows += sum(future.result() for future in done)
+                pending.add(pool.submit(move, user))
+                count += 1
+            for future in as_completed(pending):
+                rows += future.result()
+    finally:
+        for databases in opened:
+            databases['mysql'].close()
+    return (count, rows)
+
+
+def move_database(databases, collections, bso_num, fxa, args,
+                  checkpoint=None):
     """iterate over provided users and move their data from old to new"""
     start = time.time()
     # off chance that someone else might have written
     # a new collection table since the last time we
     # fetched.
     rows = 0
-    if args.user:
-        users = args.user
+    users = get_users(args, databases, fxa, bso_num)
+    if checkpoint and args.resume:
+        finished = checkpoint.finished(bso_num)
+        if finished:
+            logging.info("Skipping {} already moved users".format(
+                len(finished)))
+            users = (user for user in users if user[0] not in finished)
+    logging.info("Moving users with {} worker(s)".format(args.workers))
+    if args.workers > 1:
+        (count, rows) = move_users_parallel(
+            users, collections, fxa, bso_num, args, checkpoint)
     else:
-        users = get_users(args, databases, fxa, bso_num)
-    logging.info("Moving {} users".format(len(users)))
-    for user in users:
-        rows += move_user(
-            databases=databases,
-            user_data=user,
-            collections=collections,
-            fxa=fxa,
-            bso_num=bso_num,
-            args=args)
-    logging.info("Finished BSO #{} ({} rows) in {} seconds".format(
-        bso_num,
-        rows,
-        math.ceil(time.time() - start)
-    ))
+        count = 0
+        for user in users:
+            count += 1
+            rows += move_user(
+                databases=databases,
+                user_data=user,
+                collections=collections,
+                fxa=fxa,
+                bso_num=bso_num,
+                args=args,
+                checkpoint=checkpoint)
+    duration = time.time() - start
+    logging.info(
+        "Finished BSO #{} ({} users, {} rows) in {} seconds "
+        "({} rows/s)".format(
+            bso_num,
+            count,
+            rows,
+            math.ceil(duration),
+            math.floor(rows / max(duration, 1))
+        ))
     return rows
 
 
@@ -570,14 +1054,46 @@ def get_args():
         default="users.csv",
         help="FXA User info in CSV format"
     )
+    parser.add_argument(
+        '--fxa_cache',
+        default="users.db",
+        help="compiled, indexed copy of the FXA user info, built from "
+             "--fxa_file when missing or stale (set to '' to disable)"
+    )
+    parser.add_argument(
+        '--compile_fxa', action="store_true",
+        help="only compile --fxa_file into --fxa_cache, then exit"
+    )
     parser.add_argument(
         '--skip_collections', action='store_false',
         help="skip user_collections table"
     )
     parser.add_argument(
         '--readchunk',
-        default=1000,
-        help="how many rows per transaction for spanner"
+        type=int, default=1000,
+        help="how many rows to read from mysql at a time"
+    )
+    parser.add_argument(
+        '--prefetch',
+        type=int, default=1,
+        help="how many spanner commits worth of rows to read ahead from "
+             "mysql while writing (0 to disable)"
+    )
+    parser.add_argument(
+        '--max_mutations',
+        type=int, default=MAX_MUTATIONS,
+        help="spanner mutation limit used to size each commit"
+    )
+    parser.add_argument(
+        '--max_commit_bytes',
+        type=int, default=MAX_COMMIT_BYTES,
+        help="spanner byte size limit used to size each commit"
+    )
+    parser.add_argument(
+        '--max_batch_bytes',
+        type=int, default=MAX_BATCH_BYTES,
+        help="cap on the (estimated) bytes of rows packed into a commit, "
+             "which bounds each worker's memory"
     )
     parser.add_argument(
         '--user',
@@ -596,12 +1112,28 @@ def get_args():
     )
     parser.add_argument(
         '--user_range',
-        help="Range of users to extract (offset:limit)"
+        help="Range of userids to extract (start:end, end exclusive)"
     )
     parser.add_argument(
         '--sort_users', action="store_true",
         help="Sort the user"
     )
+    parser.add_argument(
+        '--checkpoint',
+        help="sqlite journal recording moved users and committed chunks "
+             "(default: migrate_node_{start_bso}-{end_bso}.journal, "
+             "set to '' to disable)"
+    )
+    parser.add_argument(
+        '--resume', action="store_true",
+        help="skip users and chunks already recorded in the checkpoint"
+    )
+    parser.add_argument(
+        '--workers',
+        type=int, default=1,
+        help="number of users to move concurrently (each worker uses "
+             "its own mysql connection and spanner session)"
+    )
 
     return parser.parse_args()
 
@@ -617,8 +1149,10 @@ def main():
         stream=sys.stdout,
         level=log_level,
     )
-    dsns = open(args.dsns).readlines()
-    databases = {}
+    if args.compile_fxa:
+        FXA_info(args.fxa_file, args)
+        return
+    args.dsn_lines = open(args.dsns).readlines()
     rows = 0
 
     if args.user:
@@ -629,16 +1163,24 @@ def main():
         for id in userid.split(','):
             user_list.append(int(id))
         args.user = user_list
-    for line in dsns:
-        dsn = urlparse(line.strip())
-        scheme = dsn.scheme
-        if 'mysql' in dsn.scheme:
-            scheme = 'mysql'
-        databases[scheme] = conf_db(dsn)
+    if args.checkpoint is None:
+        # one journal per bso range, so parallel runs don't share one.
+        args.checkpoint = "migrate_node_{}-{}.journal".format(
+            args.start_bso, args.end_bso)
+    databases = conf_databases(args.dsn_lines)
     if not databases.get('mysql') or not databases.get('spanner'):
         RuntimeError("Both mysql and spanner dsns must be specified")
     fxa_info = FXA_info(args.fxa_file, args)
+    if fxa_info.fxa_csv_file:
+        # Only decode the token file entries for the users being moved.
+        user_ids = set()
+        for bso_num in range(args.start_bso, args.end_bso+1):
+            user_ids.update(get_user_ids(args, databases, bso_num))
+        fxa_info.load(user_ids)
     collections = Collections(databases)
+    checkpoint = None
+    if args.checkpoint and not args.dryrun:
+        checkpoint = Checkpoint(args.checkpoint)
     logging.info("Starting:")
     if args.dryrun:
         logging.info("=== DRY RUN MODE ===")
@@ -646,10 +1188,13 @@ def main():
     for bso_num in range(args.start_bso, args.end_bso+1):
         logging.info("Moving users in bso # {}".format(bso_num))
         rows += move_database(
-            databases, collections, bso_num, fxa_info, args)
+            databases, collections, bso_num, fxa_info, args, checkpoint)
+    if checkpoint:
+        checkpoint.close()
+    duration = time.time() - start
     logging.info(
-        "Moved: {} rows in {} seconds".format(
-            rows or 0, time.time() - start))
+        "Moved: {} rows in {} seconds ({} rows/s)".format(
+            rows or 0, duration, math.floor(rows / max(duration, 1))))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,104 @@
+# Payload anonymizer for the dump tools.
+#
+# Sync payloads are small JSON objects, usually
+# `{"IV": "<base64>", "hmac": "<hex>", "ciphertext": "<base64>"}`.
+# Anonymizer replaces the values of the chosen fields with random values
+# of the same length and alphabet. Fields are found with plain str.find
+# searches rather than regular expressions, and the random values come
+# from pools filled by a single os.urandom call at a time.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import base64
+import binascii
+import os
+
+POOL_SIZE = 1 << 20
+WHITESPACE = " \t\r\n"
+
+
+class RandomPool:
+    """Random base64 and hex characters, drawn in bulk"""
+    def __init__(self, size=POOL_SIZE):
+        self.size = size
+        self.b64 = ""
+        self.b64_pos = 0
+        self.hex = ""
+        self.hex_pos = 0
+
+    def b64_chars(self, count):
+        if self.b64_pos + count > len(self.b64):
+            # every character of a base64 encoding of random bytes is
+            # itself uniformly random.
+            self.b64 = base64.b64encode(
+                os.urandom(max(self.size, count) // 4 * 3 + 3)).decode()
+            self.b64_pos = 0
+        start = self.b64_pos
+        self.b64_pos += count
+        return self.b64[start:self.b64_pos]
+
+    def hex_chars(self, count):
+        if self.hex_pos + count > len(self.hex):
+            self.hex = binascii.hexlify(
+                os.urandom(max(self.size, count) // 2 + 1)).decode()
+            self.hex_pos = 0
+        start = self.hex_pos
+        self.hex_pos += count
+        return self.hex[start:self.hex_pos]
+
+
+class Anonymizer:
+    """Replaces the IV (and optionally hmac and ciphertext) of payloads"""
+    def __init__(self, ciphertext=False, hmac=False, pool=None):
+        self.pool = pool or RandomPool()
+        # (quoted field name, how to replace its value)
+        fields = [('"IV"', self.random_b64)]
+        if hmac:
+            fields.append(('"hmac"', self.random_hex))
+        if ciphertext:
+            fields.append(('"ciphertext"', self.random_b64))
+        # clients write `"name":"value"`, which is looked for first.
+        self.fields = [
+            (name, name + ':"', len(name) + 2, replace)
+            for (name, replace) in fields]
+
+    def random_b64(self, value):
+        """random base64 the same length, and padding, as `value`"""
+        data = value.rstrip("=")
+        return self.pool.b64_chars(len(data)) + "=" * (len(value) - len(data))
+
+    def random_hex(self, value):
+        return self.pool.hex_chars(len(value))
+
+    def anonymize(self, payload):
+        # Searching from the end finds IV and hmac after only a few
+        # characters, as they come after the (long) ciphertext.
+        for (name, compact, skip, replace) in self.fields:
+            value_start = payload.rfind(compact) + skip
+            if value_start < skip:
+                value_start = self.find_value(payload, name)
+                if value_start is None:
+                    continue
+            value_end = payload.find('"', value_start)
+            if value_end < 0:
+                continue
+            payload = "".join((
+                payload[:value_start],
+                replace(payload[value_start:value_end]),
+                payload[value_end:]))
+        return payload
+
+    def find_value(self, payload, name):
+        """where the string value of the `name` field starts, if any"""
+        pos = payload.rfind(name)
+        while pos >= 0:
+            value_start = payload.find('"', pos + len(name)) + 1
+            # it's only a field name if followed by `:` and a string.
+            if value_start and payload[
+                    pos + len(name):value_start - 1].strip(
+                        WHITESPACE) == ":":
+                return value_start
+            pos = payload.rfind(name, 0, pos)
+        return None
@@ -0,0 +1,193 @@
+# Fast reader for avro object container files.
+#
+# The counterpart of avro_writer.py: rather than decoding each record
+# through the avro library's generic DatumReader, the file's record
+# schema is compiled into a single function that decodes one row tuple,
+# with its values in the order the caller asks for.
+#
+# Only records of primitive fields, or ["null", <primitive>] unions, are
+# supported, which covers the schemas used by these tools. The snappy and
+# zstandard codecs need the `python-snappy` and `zstandard` packages.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import json
+import struct
+import zlib
+
+from avro_writer import MAGIC
+
+
+def read_long(data, pos):
+    """the zig-zag varint at `pos` in `data`, returns (value, next pos)"""
+    byte = data[pos]
+    pos += 1
+    n = byte & 0x7F
+    shift = 7
+    while byte & 0x80:
+        byte = data[pos]
+        pos += 1
+        n |= (byte & 0x7F) << shift
+        shift += 7
+    return ((n >> 1) ^ -(n & 1), pos)
+
+
+def _stream_long(stream, byte=b""):
+    """read a zig-zag varint, which may start with an already read byte"""
+    n = 0
+    shift = 0
+    while True:
+        if not byte:
+            byte = stream.read(1)
+            if not byte:
+                raise EOFError("Truncated avro file")
+        n |= (byte[0] & 0x7F) << shift
+        shift += 7
+        if not byte[0] & 0x80:
+            return (n >> 1) ^ -(n & 1)
+        byte = b""
+
+
+# statements decoding `v` from `data` at `pos`; single byte varints, most
+# lengths and small ids, are decoded inline.
+LONG = [
+    "b = data[pos]",
+    "if b < 0x80:",
+    "    v = (b >> 1) ^ -(b & 1)",
+    "    pos += 1",
+    "else:",
+    "    (v, pos) = read_long(data, pos)"]
+PRIMITIVES = {
+    "null": ["v = None"],
+    "boolean": ["v = data[pos] != 0", "pos += 1"],
+    "int": LONG,
+    "long": LONG,
+    "float": ["(v,) = unpack_float(data, pos)", "pos += 4"],
+    "double": ["(v,) = unpack_double(data, pos)", "pos += 8"],
+    "bytes": LONG + ["v = bytes(data[pos:pos + v])", "pos += len(v)"],
+    "string": LONG + [
+        "end = pos + v",
+        "v = str(data[pos:end], 'utf-8')",
+        "pos = end"],
+}
+
+
+def _field_lines(name, avro_type):
+    if isinstance(avro_type, dict):
+        avro_type = avro_type.get("type")
+    if isinstance(avro_type, str) and avro_type in PRIMITIVES:
+        return PRIMITIVES[avro_type]
+    if isinstance(avro_type, list) and len(avro_type) == 2 and \
+            "null" in avro_type:
+        null = avro_type.index("null")
+        other = avro_type[1 - null]
+        if other in PRIMITIVES:
+            lines = LONG + ["if v == {}:".format(null),
+                            "    v = None",
+                            "else:"]
+            return lines + ["    " + line for line in PRIMITIVES[other]]
+    raise ValueError("Unsupported type for {}: {}".format(name, avro_type))
+
+
+def compile_decoder(schema, columns):
+    """a function(data, pos) decoding the record at `pos`, returns (the
+    row tuple with its values in `columns` order, next pos)"""
+    if schema.get("type") != "record":
+        raise ValueError("Only record schemas are supported")
+    names = [field["name"] for field in schema["fields"]]
+    missing = [column for column in columns if column not in names]
+    if missing:
+        raise ValueError("Not in the schema: {}".format(missing))
+    lines = ["def decode(data, pos):"]
+    for field in schema["fields"]:
+        lines += ["    " + line
+                  for line in _field_lines(field["name"], field["type"])]
+        if field["name"] in columns:
+            lines.append("    f_{} = v".format(names.index(field["name"])))
+    lines.append("    return (({},), pos)".format(", ".join(
+        "f_{}".format(names.index(column)) for column in columns)))
+    namespace = {
+        "read_long": read_long,
+        "unpack_float": struct.Struct("<f").unpack_from,
+        "unpack_double": struct.Struct("<d").unpack_from,
+    }
+    exec("\n".join(lines), namespace)
+    return namespace["decode"]
+
+
+def get_decompressor(codec):
+    """a function decompressing one block's bytes for `codec`"""
+    if codec == "null":
+        return bytes
+    if codec == "deflate":
+        return lambda data: zlib.decompress(data, -15)
+    if codec == "snappy":
+        import snappy
+        # the block ends with a CRC32 of the uncompressed data.
+        return lambda data: snappy.decompress(data[:-4])
+    if codec == "zstandard":
+        import zstandard
+        decompressor = zstandard.ZstdDecompressor()
+        return lambda data: decompressor.decompressobj().decompress(data)
+    raise ValueError("Unknown codec: {}".format(codec))
+
+
+class AvroReader:
+    """Reads the rows of an avro object container file as tuples.
+
+    `columns` are the fields to read, in the order they are wanted in
+    each row (all of the schema's fields, in its order, by default).
+    """
+    def __init__(self, stream, columns=None):
+        self.stream = stream
+        meta = self.read_header()
+        self.schema = json.loads(meta["avro.schema"])
+        self.fields = [field["name"] for field in self.schema["fields"]]
+        self.columns = list(columns or self.fields)
+        self.decode = compile_decoder(self.schema, self.columns)
+        self.decompress = get_decompressor(
+            meta.get("avro.codec", b"null").decode("utf-8"))
+
+    def read_header(self):
+        if self.stream.read(len(MAGIC)) != MAGIC:
+            raise ValueError("Not an avro file")
+        meta = {}
+        while True:
+            count = _stream_long(self.stream)
+            if count == 0:
+                break
+            if count < 0:
+                # followed by the size of the entries in bytes.
+                count = -count
+                _stream_long(self.stream)
+            for _ in range(count):
+                key = self.stream.read(_stream_long(self.stream))
+                meta[key.decode("utf-8")] = self.stream.read(
+                    _stream_long(self.stream))
+        self.sync_marker = self.stream.read(16)
+        return meta
+
+    def blocks(self):
+        """yield the (row count, decompressed data) of each block"""
+        while True:
+            byte = self.stream.read(1)
+            if not byte:
+                return
+            count = _stream_long(self.stream, byte)
+            data = self.stream.read(_stream_long(self.stream))
+            if self.stream.read(16) != self.sync_marker:
+                raise ValueError("Bad avro sync marker")
+            yield (count, memoryview(self.decompress(data)))
+
+    def __iter__(self):
+        decode = self.decode
+        for (count, data) in self.blocks():
+            pos = 0
+            for _ in range(count):
+                (row, pos) = decode(data, pos)
+                yield row
+
+    def close(self):
+        self.stream.close()
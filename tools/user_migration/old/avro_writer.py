@@ -0,0 +1,198 @@
+# Fast writer for avro object container files.
+#
+# The avro library's DataFileWriter validates and encodes each datum dict
+# field by field through generic code, which ends up being where the dump
+# tools spend their CPU. AvroWriter instead compiles the record schema
+# (e.g. sync.avsc) into a single function that encodes a row tuple
+# straight into a block buffer, which is reused for every block. The
+# files it produces are ordinary avro files.
+#
+# Only records of primitive fields, or ["null", <primitive>] unions, are
+# supported, which covers the schemas used by these tools. The snappy and
+# zstandard codecs need the `python-snappy` and `zstandard` packages.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import json
+import os
+import struct
+import zlib
+
+MAGIC = b"Obj\x01"
+BLOCK_SIZE = 1024 * 1024
+CODECS = ("null", "deflate", "snappy", "zstandard")
+
+# zig-zag varints for the values most lengths and small ids fall in.
+SMALL_LONGS = 1 << 14
+
+
+def _encode_long(n):
+    n = (n << 1) ^ (n >> 63)
+    out = bytearray()
+    while n & ~0x7F:
+        out.append((n & 0x7F) | 0x80)
+        n >>= 7
+    out.append(n)
+    return bytes(out)
+
+
+_small = [_encode_long(n) for n in range(-SMALL_LONGS, SMALL_LONGS)]
+
+
+def encode_long(n):
+    """the avro (zig-zag varint) encoding of an int or long"""
+    if -SMALL_LONGS <= n < SMALL_LONGS:
+        return _small[n + SMALL_LONGS]
+    return _encode_long(n)
+
+
+# primitive type => statements appending `v` to `out`
+PRIMITIVES = {
+    "null": [],
+    "boolean": ["out += b'\\x01' if v else b'\\x00'"],
+    "int": ["out += encode_long(v)"],
+    "long": ["out += encode_long(v)"],
+    "float": ["out += pack_float(v)"],
+    "double": ["out += pack_double(v)"],
+    "bytes": ["out += encode_long(len(v))", "out += v"],
+    "string": [
+        "v = v.encode('utf-8')",
+        "out += encode_long(len(v))",
+        "out += v"],
+}
+
+
+def _field_lines(name, avro_type):
+    if isinstance(avro_type, dict):
+        avro_type = avro_type.get("type")
+    if isinstance(avro_type, str) and avro_type in PRIMITIVES:
+        return PRIMITIVES[avro_type]
+    if isinstance(avro_type, list) and len(avro_type) == 2 and \
+            "null" in avro_type:
+        null = avro_type.index("null")
+        other = avro_type[1 - null]
+        if other in PRIMITIVES:
+            lines = ["if v is None:",
+                     "    out += {!r}".format(encode_long(null)),
+                     "else:",
+                     "    out += {!r}".format(encode_long(1 - null))]
+            return lines + ["    " + line for line in PRIMITIVES[other]]
+    raise ValueError("Unsupported type for {}: {}".format(name, avro_type))
+
+
+def compile_encoder(schema, columns):
+    """a function(row, out) appending the encoded row tuple, whose values
+    are in `columns` order, to the bytearray `out`"""
+    if schema.get("type") != "record":
+        raise ValueError("Only record schemas are supported")
+    lines = ["def encode(row, out):"]
+    for field in schema["fields"]:
+        lines.append("    v = row[{}]".format(columns.index(field["name"])))
+        lines += ["    " + line
+                  for line in _field_lines(field["name"], field["type"])]
+    namespace = {
+        "encode_long": encode_long,
+        "pack_float": struct.Struct("<f").pack,
+        "pack_double": struct.Struct("<d").pack,
+    }
+    exec("\n".join(lines), namespace)
+    return namespace["encode"]
+
+
+def get_compressor(codec, level=None):
+    """a function compressing one block's bytes for `codec`"""
+    if codec == "null":
+        return bytes
+    if codec == "deflate":
+        def deflate(data):
+            compressor = zlib.compressobj(
+                -1 if level is None else level, zlib.DEFLATED, -15)
+            return compressor.compress(data) + compressor.flush()
+        return deflate
+    if codec == "snappy":
+        import snappy
+
+        def compress_snappy(data):
+            return snappy.compress(bytes(data)) + struct.pack(
+                ">I", zlib.crc32(data) & 0xFFFFFFFF)
+        return compress_snappy
+    if codec == "zstandard":
+        import zstandard
+        return zstandard.ZstdCompressor(level=level or 3).compress
+    raise ValueError("Unknown codec: {}".format(codec))
+
+
+class AvroWriter:
+    """Writes row tuples to an avro object container file.
+
+    `schema` is the record schema (JSON text or parsed), `columns` the
+    order of the values in each row (the schema's field order by
+    default).
+    """
+    def __init__(self, stream, schema, columns=None, codec="null",
+                 block_size=BLOCK_SIZE, level=None):
+        if isinstance(schema, (str, bytes)):
+            schema = json.loads(schema)
+        self.fields = [field["name"] for field in schema["fields"]]
+        self.columns = list(columns or self.fields)
+        self.encode = compile_encoder(schema, self.columns)
+        self.compress = get_compressor(codec, level)
+        self.stream = stream
+        self.block_size = block_size
+        self.buffer = bytearray()
+        self.count = 0
+        self.sync_marker = os.urandom(16)
+        self.write_header(schema, codec)
+
+    def write_header(self, schema, codec):
+        header = bytearray(MAGIC)
+        meta = {
+            "avro.schema": json.dumps(schema).encode("utf-8"),
+            "avro.codec": codec.encode("utf-8"),
+        }
+        header += encode_long(len(meta))
+        for (key, value) in meta.items():
+            key = key.encode("utf-8")
+            header += encode_long(len(key)) + key
+            header += encode_long(len(value)) + value
+        header += encode_long(0)
+        header += self.sync_marker
+        self.stream.write(header)
+
+    def append_row(self, row):
+        self.encode(row, self.buffer)
+        self.count += 1
+        if len(self.buffer) >= self.block_size:
+            self.flush()
+
+    def append_rows(self, rows):
+        encode = self.encode
+        buffer = self.buffer
+        block_size = self.block_size
+        for row in rows:
+            encode(row, buffer)
+            self.count += 1
+            if len(buffer) >= block_size:
+                self.flush()
+
+    def append(self, datum):
+        """DataFileWriter style, from a dict"""
+        self.append_row(tuple(datum.get(column) for column in self.columns))
+
+    def flush(self):
+        if not self.count:
+            return
+        data = self.compress(self.buffer)
+        self.stream.write(
+            encode_long(self.count) + encode_long(len(data)))
+        self.stream.write(data)
+        self.stream.write(self.sync_marker)
+        # keep the buffer (and its allocation) for the next block.
+        del self.buffer[:]
+        self.count = 0
+
+    def close(self):
+        self.flush()
+        self.stream.close()
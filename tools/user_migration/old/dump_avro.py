@@ -2,22 +2,41 @@
 
 # painfully stupid script to check out dumping a spanner database to avro.
 # Avro is basically "JSON" for databases. It's not super complicated & it has
-# issues (one of which is that it requires Python2).
-# test run Dumped 2770783 rows in 457.566066027 seconds and produced a
-# roughly 6.5GB file.
+# issues.
+#
+# The bsos primary key space is split into `--partitions` fxa_uid ranges,
+# which `--workers` processes each stream into their own avro chunk file,
+# `{output}_{hex(partition)}.{ext}`. A chunk is written as `.part` and
+# renamed once complete, so re-running the same command skips the
+# partitions that are already done.
 #
 # Spanner also has a Deadline issue where it will kill a db connection after
-# so many minutes (5?). Might be better to just divvy things up into clusters
-# and have threads handle transporting records over.
+# so many minutes (5?). Rows are read in primary key order, so when that
+# happens the partition's query is restarted after the last row written
+# rather than re-reading anything.
+#
+# With `--format parquet` the chunks are parquet files instead (see
+# parquet_writer.py), which analytics tools can scan by column.
 #
 
-import avro.schema
 import argparse
+import os
 import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
-from avro.datafile import DataFileWriter
-from avro.io import DatumWriter
+from avro_writer import AvroWriter, BLOCK_SIZE, CODECS
+from google.api_core.exceptions import GoogleAPICallError
 from google.cloud import spanner
+from google.cloud.spanner_v1 import param_types
+from parquet_writer import ParquetWriter, ROW_GROUP_SIZE
+
+# the order of the values in each row read_range() yields
+COLUMNS = ("collection_id", "fxa_kid", "fxa_uid", "bso_id", "expiry",
+           "modified", "payload", "sortindex")
+
+# per worker process, see init_worker()
+database = None
+schema = None
 
 
 def get_args():
@@ -32,12 +51,35 @@ def get_args():
         '--schema', default="sync.avsc",
         help="Database schema description")
     parser.add_argument(
-        '--output', default="output.avso",
-        help="Output file")
+        '--output',
+        help="Output file prefix (default: output.avso, or "
+             "output.parquet with --format parquet)")
+    parser.add_argument(
+        '--partitions', type=int, default=64,
+        help="Number of fxa_uid ranges (and chunk files) to split into")
+    parser.add_argument(
+        '--workers', type=int, default=4,
+        help="Number of partitions to dump at once")
     parser.add_argument(
-        '--limit', type=int, default=1500000,
-        help="Limit to n rows")
-    return parser.parse_args()
+        '--retries', type=int, default=5,
+        help="Times to restart a partition's query without progress")
+    parser.add_argument(
+        '--codec', default="null", choices=CODECS,
+        help="Avro block compression codec")
+    parser.add_argument(
+        '--block_size', type=int, default=BLOCK_SIZE,
+        help="Bytes of rows per avro block")
+    parser.add_argument(
+        '--format', default="avro", choices=("avro", "parquet"),
+        help="Output file format")
+    parser.add_argument(
+        '--row_group_size', type=int, default=ROW_GROUP_SIZE,
+        help="Rows per parquet row group")
+    args = parser.parse_args()
+    if not args.output:
+        args.output = "output.{}".format(
+            "parquet" if args.format == "parquet" else "avso")
+    return args
 
 
 def conf_spanner(args):
@@ -47,63 +89,155 @@ def conf_spanner(args):
     return database
 
 
-def dump_rows(offset, db, writer, args):
-    print("Querying.... @{}".format(offset))
+def init_worker(args):
+    global database, schema
+    database = conf_spanner(args)
+    schema = open(args.schema).read()
+
+
+def key_ranges(count):
+    """split the fxa_uid keyspace into `count` (start, end) ranges.
+
+    The boundaries are evenly spaced hex prefixes. The first range has no
+    start and the last no end, so every fxa_uid falls in exactly one
+    range.
+
+    """
+    if count <= 1:
+        return [(None, None)]
+    width = 1
+    while 16 ** width < count:
+        width += 1
+    bounds = [None] + [
+        "{:0{}x}".format(i * 16 ** width // count, width)
+        for i in range(1, count)
+    ] + [None]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def open_writer(file_name, args):
+    if args.format == "parquet":
+        return ParquetWriter(
+            open(file_name, "wb"), schema, columns=COLUMNS,
+            row_group_size=args.row_group_size)
+    return AvroWriter(
+        open(file_name, "wb"), schema, columns=COLUMNS,
+        codec=args.codec, block_size=args.block_size)
+
+
+def chunk_name(output, partition):
+    out_file = output.rsplit('.', 1)
+    return "{}_{}.{}".format(out_file[0], hex(partition), out_file[1])
+
+
+def read_range(db, key_range, after=None):
+    """stream the bsos in a range, in primary key order, that come after
+    the `after` (fxa_uid, fxa_kid, collection_id, bso_id) key"""
+    (start, end) = key_range
+    conditions = ["TRUE"]
+    params = {}
+    types = {}
+    if start is not None:
+        conditions.append("fxa_uid >= @start")
+        params["start"] = start
+        types["start"] = param_types.STRING
+    if end is not None:
+        conditions.append("fxa_uid < @end")
+        params["end"] = end
+        types["end"] = param_types.STRING
+    if after is not None:
+        conditions.append(
+            "(fxa_uid > @uid OR (fxa_uid = @uid AND "
+            "(fxa_kid > @kid OR (fxa_kid = @kid AND "
+            "(collection_id > @cid OR (collection_id = @cid AND "
+            "bso_id > @bid))))))")
+        (params["uid"], params["kid"], params["cid"], params["bid"]) = after
+        types.update(
+            uid=param_types.STRING, kid=param_types.STRING,
+            cid=param_types.INT64, bid=param_types.STRING)
     sql = """
     SELECT collection_id, fxa_kid, fxa_uid, bso_id,
     UNIX_MICROS(expiry), UNIX_MICROS(modified), payload,
-    sortindex from bsos LIMIT {} OFFSET {}""".format(args.limit, offset)
-    try:
-        with db.snapshot() as snapshot:
-            result = snapshot.execute_sql(sql)
-            print("Dumping...")
-            for row in result:
-                writer.append({
-                    "collection_id": row[0],
-                    "fxa_kid": row[1],
-                    "fxa_uid": row[2],
-                    "bso_id": row[3],
-                    "expiry": row[4],
-                    "modified": row[5],
-                    "payload": row[6],
-                    "sortindex": row[7]})
-                offset += 1
-                if offset % 1000 == 0:
-                    print("Row: {}".format(offset))
-            return offset
-    except Exception as ex:
-        print("Deadline hit at: {} ({})".format(offset, ex))
-        return offset
-
-
-def count_rows(db):
+    sortindex from bsos WHERE {}
+    ORDER BY fxa_uid, fxa_kid, collection_id, bso_id""".format(
+        " AND ".join(conditions))
     with db.snapshot() as snapshot:
-        result = snapshot.execute_sql("SELECT Count(*) from bsos")
-        return result.one()[0]
-
-
-def dump_data(args, schema):
-    offset = 0
-    # things time out around 1_500_000 rows.
-    db = conf_spanner(args)
-    writer = DataFileWriter(
-        open(args.output, "wb"), DatumWriter(), schema)
-    row_count = count_rows(db)
-    print("Dumping {} rows".format(row_count))
-    while offset < row_count:
-        old_offset = offset
-        offset = dump_rows(offset=offset, db=db, writer=writer, args=args)
-        if offset == old_offset:
-            break
-    writer.close()
-    return row_count
+        yield from snapshot.execute_sql(
+            sql, params=params, param_types=types)
+
+
+def dump_partition(partition, key_range, args):
+    """dump one range into its chunk file, returns the number of rows"""
+    out_file_name = chunk_name(args.output, partition)
+    part_file_name = "{}.part".format(out_file_name)
+    writer = open_writer(part_file_name, args)
+    rows = 0
+    last = None
+    stalled = 0
+    stalled_at = None
+    try:
+        while True:
+            try:
+                for row in read_range(database, key_range, last):
+                    writer.append_row(row)
+                    last = (row[2], row[1], row[0], row[3])
+                    rows += 1
+                    if rows % 100000 == 0:
+                        print("Partition {} Row: {}".format(
+                            hex(partition), rows))
+                break
+            except GoogleAPICallError as ex:
+                stalled = stalled + 1 if rows == stalled_at else 1
+                stalled_at = rows
+                if stalled > args.retries:
+                    raise
+                print("Deadline hit in partition {} at: {} ({})".format(
+                    hex(partition), rows, ex))
+    finally:
+        writer.close()
+    os.replace(part_file_name, out_file_name)
+    return rows
+
+
+def dump_data(args):
+    rows = 0
+    failed = 0
+    partitions = [
+        (partition, key_range)
+        for (partition, key_range) in enumerate(key_ranges(args.partitions))
+        if not os.path.exists(chunk_name(args.output, partition))
+    ]
+    print("Dumping {} of {} partitions".format(
+        len(partitions), args.partitions))
+    with ProcessPoolExecutor(
+            max_workers=args.workers,
+            initializer=init_worker,
+            initargs=(args,)) as pool:
+        futures = dict(
+            (pool.submit(dump_partition, partition, key_range, args),
+             partition)
+            for (partition, key_range) in partitions)
+        for future in as_completed(futures):
+            partition = futures[future]
+            try:
+                count = future.result()
+            except Exception as ex:
+                failed += 1
+                print("Could not dump partition {}: {}".format(
+                    hex(partition), ex))
+                continue
+            rows += count
+            print("Dumped partition {}: {} rows".format(
+                hex(partition), count))
+    if failed:
+        print("{} partitions failed, re-run to retry them".format(failed))
+    return rows
 
 
 def main():
     start = time.time()
     args = get_args()
-    schema = avro.schema.parse(open(args.schema, "rb").read())
-    rows = dump_data(args, schema)
+    rows = dump_data(args)
     print("Dumped: {} rows in {} seconds".format(rows, time.time() - start))
 
 
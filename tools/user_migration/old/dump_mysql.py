@@ -9,29 +9,46 @@
 # Avro is basically "JSON" for databases. It's not super complicated & it has
 # issues.
 #
+# Each bso{N} table is split into chunks of `--chunk_users` userids, and
+# `--workers` processes (each with its own connection) dump chunks from
+# all of the shards at once, paging through them in primary key order.
+# Chunk files are named `{output}_{dsn}_{bso}_{chunk}`, where dsn is the
+# DSN's line number in `--dsns`. Every finished chunk gets a `.manifest`
+# (JSON, with its row count) next to its avro file; re-running the same
+# command only dumps the chunks without one. Anonymous fxa ids are derived
+# with a key kept in `--anon_key`, so re-dumped chunks get the same ids.
+#
+# With `--format parquet` the chunks (and the user_collections file) are
+# parquet files instead (see parquet_writer.py), which analytics tools
+# can scan by column.
+#
 
 import avro.schema
 import argparse
 import binascii
 import csv
 import base64
-import math
+import hashlib
+import hmac
+import json
 import time
 import os
 import random
-import re
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 from avro.datafile import DataFileWriter
 from avro.io import DatumWriter
+from anonymize import Anonymizer
+from avro_writer import AvroWriter, BLOCK_SIZE, CODECS
 from mysql import connector
+from parquet_writer import ParquetWriter, ROW_GROUP_SIZE
 try:
     from urllib.parse import urlparse
 except:
     from urlparse import urlparse
 
 
-MAX_ROWS=1500000
-
 class BadDSNException(Exception):
     pass
 
@@ -49,19 +66,54 @@ def get_args():
         help="User Collection schema description"
     )
     parser.add_argument(
-        '--output', default="output.avso",
-        help="Output file")
+        '--output',
+        help="Output file (default: output.avso, or output.parquet with "
+             "--format parquet)")
     parser.add_argument(
-        '--limit', type=int, default=1500000,
-        help="Limit each read chunk to n rows")
+        '--limit', type=int, default=10000,
+        help="Limit each read page to n rows")
     parser.add_argument(
         '--offset', type=int, default=0,
         help="UID to start at")
+    parser.add_argument(
+        '--chunk_users', type=int, default=100000,
+        help="Range of userids dumped into each chunk file")
+    parser.add_argument(
+        '--workers', type=int, default=4,
+        help="Number of chunks to dump at once")
+    parser.add_argument(
+        '--retries', type=int, default=5,
+        help="Times to retry a page read before giving up on a chunk")
+    parser.add_argument(
+        '--codec', default="null", choices=CODECS,
+        help="Avro block compression codec")
+    parser.add_argument(
+        '--block_size', type=int, default=BLOCK_SIZE,
+        help="Bytes of rows per avro block")
+    parser.add_argument(
+        '--format', default="avro", choices=("avro", "parquet"),
+        help="Output file format")
+    parser.add_argument(
+        '--row_group_size', type=int, default=ROW_GROUP_SIZE,
+        help="Rows per parquet row group")
     parser.add_argument(
         '--deanon', action='store_false',
         dest='anon',
         help="Anonymize the user data"
     )
+    parser.add_argument(
+        '--anon_ciphertext', action='store_true',
+        help="Also replace payload ciphertexts when anonymizing"
+    )
+    parser.add_argument(
+        '--anon_hmac', action='store_true',
+        help="Also replace payload hmacs when anonymizing"
+    )
+    parser.add_argument(
+        '--anon_key',
+        help="file holding the key anonymous fxa ids are derived from, "
+             "created if missing (default: {output}.anon_key)"
+    )
     parser.add_argument(
         '--start_bso', default=0,
         type=int,
@@ -78,11 +130,20 @@ def get_args():
         help="token user database dump CSV"
     )
     parser.add_argument(
-        '--skip_collections', action='store_false',
+        '--token_cache',
+        help="token user sqlite cache compiled by "
+             "`migrate_node.py --compile_fxa` (used instead of --token_file)"
+    )
+    parser.add_argument(
+        '--skip_collections', action='store_true',
         help="skip user_collections table"
     )
 
-    return parser.parse_args()
+    args = parser.parse_args()
+    if not args.output:
+        args.output = "output.{}".format(
+            "parquet" if args.format == "parquet" else "avso")
+    return args
 
 
 def conf_db(dsn):
@@ -114,6 +175,14 @@ def format_key_id(keys_changed_at, key_hash):
 
 
 user_ids = {}
+token_cache = None
+# per run key for anonymous ids, so that every worker process maps a
+# userid to the same one.
+anon_key = None
+# per worker process, see init_worker()
+schema = None
+anonymizer = None
+connections = {}
 
 def read_in_token_file(filename):
     global user_ids
@@ -140,20 +209,50 @@ def read_in_token_file(filename):
             user_ids[uid] = (fxa_kid, fxa_uid)
 
 
+def open_token_cache(filename):
+    global token_cache
+    # The cache is keyed by uid, so users are looked up as needed
+    # rather than read into memory up front.
+    token_cache = sqlite3.connect(
+        "file:{}?mode=ro".format(filename), uri=True)
+
+
 def get_fxa_id(user_id, anon=True):
     global user_ids
     if user_id in user_ids:
         return user_ids[user_id]
+    if token_cache is not None:
+        row = token_cache.execute(
+            "SELECT fxa_kid, fxa_uid FROM users WHERE uid = ?",
+            (user_id,)).fetchone()
+        if row:
+            return tuple(row)
     if anon:
-        fxa_uid = binascii.hexlify(
-            os.urandom(16)).decode('utf-8')
-        fxa_kid = binascii.hexlify(
-            os.urandom(16)).decode('utf-8')
+        digest = hmac.new(
+            anon_key, str(user_id).encode('utf-8'), hashlib.sha256
+        ).hexdigest()
+        fxa_uid = digest[:32]
+        fxa_kid = digest[32:]
         user_ids[user_id] = (fxa_kid, fxa_uid)
         return (fxa_kid, fxa_uid)
 
 
-def dump_user_collections(schema, dsn, args):
+def load_anon_key(args):
+    """the key for anonymous fxa ids, the same for every run"""
+    path = args.anon_key or "{}.anon_key".format(
+        args.output.rsplit('.', 1)[0])
+    if os.path.exists(path):
+        with open(path) as key_file:
+            return binascii.unhexlify(key_file.read().strip())
+    key = os.urandom(32)
+    key_file = os.fdopen(
+        os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600), "w")
+    with key_file:
+        key_file.write(binascii.hexlify(key).decode('ascii'))
+    return key
+
+
+def dump_user_collections(schema, dsn_number, dsn, args):
     # userid => fxa_kid
     #           fxa_uid
     # collection => collection_id
@@ -161,11 +260,16 @@ def dump_user_collections(schema, dsn, args):
     db = conf_db(dsn)
     cursor = db.cursor()
     out_file = args.output.rsplit('.', 1)
-    out_file_name = "{}_user_collections.{}".format(
-        out_file[0], out_file[1]
+    out_file_name = "{}_{}_user_collections.{}".format(
+        out_file[0], dsn_number, out_file[1]
     )
-    writer = DataFileWriter(
-        open(out_file_name, "wb"), DatumWriter(), schema)
+    if args.format == "parquet":
+        writer = ParquetWriter(
+            open(out_file_name, "wb"), open(args.col_schema).read(),
+            row_group_size=args.row_group_size)
+    else:
+        writer = DataFileWriter(
+            open(out_file_name, "wb"), DatumWriter(), schema)
     sql = """
     SELECT userid, collection, last_modified from user_collections
     """
@@ -174,7 +278,7 @@ def dump_user_collections(schema, dsn, args):
         cursor.execute(sql)
         row = 0
         for (user_id, collection_id, last_modified) in cursor:
-            (fxa_uid, fxa_kid) = get_fxa_id(user_id, args.anon)
+            (fxa_kid, fxa_uid) = get_fxa_id(user_id, args.anon)
             try:
                 writer.append({
                     "collection_id": collection_id,
@@ -183,8 +287,8 @@ def dump_user_collections(schema, dsn, args):
                     "modified": last_modified
                 })
             except Exception as ex:
-                import pdb; pdb.set_trace()
-                print (ex)
+                print("Could not dump user_collection {}: {}".format(
+                    (user_id, collection_id), ex))
             row += 1
         print(
             "Dumped {} user_collection rows in {} seconds".format(
@@ -195,7 +299,55 @@ def dump_user_collections(schema, dsn, args):
         cursor.close()
 
 
-def dump_rows(bso_number, chunk_offset, db, writer, args):
+def init_worker(args, key):
+    global anon_key, anonymizer, schema
+    anon_key = key
+    schema = open(args.schema).read()
+    # created after the fork, so every worker has its own randomness.
+    anonymizer = Anonymizer(
+        ciphertext=args.anon_ciphertext, hmac=args.anon_hmac)
+    if args.token_cache:
+        open_token_cache(args.token_cache)
+
+
+def get_connection(dsn, reconnect=False):
+    """this worker's connection to `dsn`"""
+    if reconnect and dsn in connections:
+        try:
+            connections.pop(dsn).close()
+        except Exception:
+            pass
+    if dsn not in connections:
+        connections[dsn] = conf_db(dsn)
+    return connections[dsn]
+
+
+def read_page(db, bso_number, user_range, after, limit):
+    """the next `limit` rows of a userid range, in primary key order,
+    after the `after` (userid, collection, id) key"""
+    conditions = ["userid >= %s", "userid < %s"]
+    params = list(user_range)
+    if after is not None:
+        (userid, collection, bso_id) = after
+        conditions.append(
+            "(userid > %s OR (userid = %s AND "
+            "(collection > %s OR (collection = %s AND id > %s))))")
+        params += [userid, userid, collection, collection, bso_id]
+    sql = """
+    SELECT userid, collection, id,
+    ttl, modified, payload,
+    sortindex from bso{} WHERE {}
+    ORDER BY userid, collection, id LIMIT {}""".format(
+        bso_number, " AND ".join(conditions), limit)
+    cursor = db.cursor()
+    try:
+        cursor.execute(sql, params)
+        return cursor.fetchall()
+    finally:
+        cursor.close()
+
+
+def dump_rows(dsn, bso_number, user_range, writer, args):
     # bso column mapping:
     # id => bso_id
     # collection => collection_id
@@ -205,106 +357,162 @@ def dump_rows(bso_number, chunk_offset, db, writer, args):
     # payload_size => NONE
     # ttl => expiry
 
-    ivre = re.compile(r'("IV": ?"[^"]+")')
-    print("Querying.... bso{} @{}".format(bso_number, chunk_offset))
-    sql = """
-    SELECT userid, collection, id,
-    ttl, modified, payload,
-    sortindex from bso{} LIMIT {} OFFSET {}""".format(
-        bso_number, args.limit, chunk_offset)
-    cursor = db.cursor()
+    print("Querying.... bso{} users {}..{}".format(
+        bso_number, *user_range))
     user = None
     row_count = 0
-    try:
-        cursor.execute(sql)
-        print("Dumping...")
-        for (userid, cid, bid, exp, mod, pay, si) in cursor:
+    after = None
+    failures = 0
+    while True:
+        try:
+            rows = read_page(
+                get_connection(dsn, reconnect=failures > 0),
+                bso_number, user_range, after, args.limit)
+        except Exception as e:
+            failures += 1
+            print("Deadline hit at: bso{} {} ({})".format(
+                bso_number, after, e))
+            if failures > args.retries:
+                raise
+            continue
+        failures = 0
+        if not rows:
+            return row_count
+        append = writer.append_row
+        anonymize = anonymizer.anonymize
+        for (userid, cid, bid, exp, mod, pay, si) in rows:
             if args.anon:
-                replacement = encode_bytes_b64(os.urandom(16))
-                pay = ivre.sub('"IV":"{}"'.format(replacement), pay)
+                pay = anonymize(pay)
             if userid != user:
                 (fxa_kid, fxa_uid) = get_fxa_id(userid, args.anon)
                 user = userid
-            writer.append({
-                "fxa_uid": fxa_uid,
-                "fxa_kid": fxa_kid,
-                "collection_id": cid,
-                "bso_id": bid,
-                "expiry": exp,
-                "modified": mod,
-                "payload": pay,
-                "sortindex": si})
+            # sync.avsc field order
+            append((fxa_uid, fxa_kid, cid, bid, exp, mod, pay, si))
             row_count += 1
-            if (chunk_offset + row_count) % 1000 == 0:
-                print("BSO:{} Row: {}".format(bso_number, chunk_offset + row_count))
-            if row_count >= MAX_ROWS:
-                break
-    except Exception as e:
-        print("Deadline hit at: {} ({})".format(
-            chunk_offset + row_count, e))
-    finally:
-        cursor.close()
-    return row_count
+        (userid, cid, bid) = rows[-1][:3]
+        after = (userid, cid, bid)
+        print("BSO:{} Row: {}".format(bso_number, row_count))
 
 
-def count_rows(db, bso_num=0):
+def user_bounds(db, bso_num=0):
+    """the (lowest, highest) userid in a bso table"""
     cursor = db.cursor()
     try:
-        cursor.execute("SELECT Count(*) from bso{}".format(bso_num))
-        return cursor.fetchone()[0]
+        cursor.execute(
+            "SELECT MIN(userid), MAX(userid) from bso{}".format(bso_num))
+        return cursor.fetchone()
     finally:
         cursor.close()
 
 
-def dump_data(bso_number, schema, dsn, args):
-    offset = args.offset or 0
-    total_rows = 0
-    # things time out around 1_500_000 rows.
-    db = conf_db(dsn)
+def open_writer(file_name, args):
+    if args.format == "parquet":
+        return ParquetWriter(
+            open(file_name, "wb"), schema,
+            row_group_size=args.row_group_size)
+    return AvroWriter(
+        open(file_name, "wb"), schema,
+        codec=args.codec, block_size=args.block_size)
+
+
+def chunk_name(args, dsn_number, bso_number, chunk):
     out_file = args.output.rsplit('.', 1)
-    row_count = count_rows(db, bso_number)
-    for chunk in range(
-        max(1, math.trunc(math.ceil(row_count / MAX_ROWS)))):
-        print(
-            "Dumping {} rows from bso#{} into chunk {}".format(
-                row_count, bso_number, chunk))
-        out_file_name = "{}_{}_{}.{}".format(
-            out_file[0], bso_number, hex(chunk), out_file[1]
-        )
-        writer = DataFileWriter(
-            open(out_file_name, "wb"), DatumWriter(), schema)
-        rows = dump_rows(
-            bso_number=bso_number,
-            chunk_offset=offset,
-            db=db,
-            writer=writer,
-            args=args)
+    return "{}_{}_{}_{}.{}".format(
+        out_file[0], dsn_number, bso_number, hex(chunk), out_file[1])
+
+
+def plan_chunks(dsn_number, dsn, bso_number, args):
+    """the (dsn number, bso, chunk, userid range) still to dump from a
+    bso table"""
+    db = conf_db(dsn)
+    try:
+        (low, high) = user_bounds(db, bso_number)
+    finally:
+        db.close()
+    if low is None:
+        return []
+    low = max(low, args.offset or 0)
+    chunks = []
+    for (chunk, start) in enumerate(
+            range(low, high + 1, args.chunk_users)):
+        if os.path.exists("{}.manifest".format(
+                chunk_name(args, dsn_number, bso_number, chunk))):
+            continue
+        chunks.append(
+            (dsn_number, bso_number, chunk,
+             (start, min(start + args.chunk_users, high + 1))))
+    return chunks
+
+
+def dump_data(dsn, dsn_number, bso_number, chunk, user_range, args):
+    """dump one chunk, then write its manifest"""
+    start = time.time()
+    out_file_name = chunk_name(args, dsn_number, bso_number, chunk)
+    part_file_name = "{}.part".format(out_file_name)
+    writer = open_writer(part_file_name, args)
+    try:
+        rows = dump_rows(dsn, bso_number, user_range, writer, args)
+    finally:
         writer.close()
-        if rows == 0:
-            break
-        offset = offset + rows
-        chunk += 1
+    os.replace(part_file_name, out_file_name)
+    manifest = {
+        "dsn": dsn_number,
+        "bso": bso_number,
+        "chunk": chunk,
+        "userids": list(user_range),
+        "rows": rows,
+        "file": os.path.basename(out_file_name),
+        "seconds": round(time.time() - start, 3),
+    }
+    with open("{}.manifest".format(out_file_name), "w") as manifest_file:
+        json.dump(manifest, manifest_file)
     return rows
 
 
 def main():
+    global anon_key
     args = get_args()
     rows = 0
-    dsns = open(args.dsns).readlines()
-    schema = avro.schema.parse(open(args.schema, "rb").read())
+    failed = 0
+    anon_key = load_anon_key(args)
+    dsns = [dsn.strip() for dsn in open(args.dsns).readlines()
+            if dsn.strip()]
     col_schema = avro.schema.parse(open(args.col_schema, "rb").read())
-    if args.token_file:
+    if args.token_cache:
+        open_token_cache(args.token_cache)
+    elif args.token_file:
         read_in_token_file(args.token_file)
     start = time.time()
-    for dsn in dsns:
+    chunks = []
+    for (dsn_number, dsn) in enumerate(dsns):
         print("Starting: {}".format(dsn))
         try:
             if not args.skip_collections:
-                dump_user_collections(col_schema, dsn, args)
+                dump_user_collections(col_schema, dsn_number, dsn, args)
             for bso_num in range(args.start_bso, args.end_bso+1):
-                rows = dump_data(bso_num, schema, dsn, args)
+                chunks += [
+                    (dsn,) + chunk
+                    for chunk in plan_chunks(dsn_number, dsn, bso_num, args)]
         except Exception as ex:
             print("Could not process {}: {}".format(dsn, ex))
+    print("Dumping {} chunks".format(len(chunks)))
+    with ProcessPoolExecutor(
+            max_workers=args.workers,
+            initializer=init_worker,
+            initargs=(args, anon_key)) as pool:
+        futures = dict(
+            (pool.submit(dump_data, *chunk, args=args), chunk)
+            for chunk in chunks)
+        for future in as_completed(futures):
+            (dsn, dsn_number, bso_num, chunk, user_range) = futures[future]
+            try:
+                rows += future.result()
+            except Exception as ex:
+                failed += 1
+                print("Could not dump {} bso{} chunk {}: {}".format(
+                    dsn, bso_num, hex(chunk), ex))
+    if failed:
+        print("{} chunks failed, re-run to retry them".format(failed))
     print("Dumped: {} rows in {} seconds".format(rows, time.time() - start))
 
 
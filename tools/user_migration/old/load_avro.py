@@ -0,0 +1,261 @@
+#! venv/bin/python
+
+# Load the avro files written by dump_mysql.py / dump_avro.py into spanner.
+#
+# The bso chunk files are loaded by `--workers` processes at once. bsos
+# are interleaved in user_collections, so, as migrate_node.py does, each
+# commit also writes the user_collections rows of its bsos, with the most
+# recent modified time of each collection (the dumped `_user_collections`
+# files are not needed, and skipped). Rows are packed into commits that
+# stay within spanner's mutation and byte limits, and written with
+# insert_or_update so that loading a file again is harmless. After every
+# commit `{file}.loaded` records how many of the file's rows are in
+# spanner, so an interrupted load skips finished files and the committed
+# rows of the others.
+#
+# Timestamps may be seconds (dump_mysql's ttl), milliseconds (mysql's
+# modified) or microseconds (dump_avro's UNIX_MICROS).
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import argparse
+import glob
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+
+from avro_reader import AvroReader
+from google.cloud import spanner
+
+MAX_MUTATIONS = 20000
+MAX_COMMIT_BYTES = 104857600
+COMMIT_HEADROOM = 0.9
+INT64_SIZE = 8
+
+UC_COLUMNS = ("fxa_uid", "fxa_kid", "collection_id", "modified")
+BSO_COLUMNS = ("fxa_uid", "fxa_kid", "collection_id", "bso_id",
+               "sortindex", "payload", "modified", "expiry")
+# BsoModified and BsoExpiry
+BSO_INDEXES = 2
+MODIFIED = BSO_COLUMNS.index("modified")
+EXPIRY = BSO_COLUMNS.index("expiry")
+
+# per worker process, see init_worker()
+database = None
+
+
+def get_args():
+    parser = argparse.ArgumentParser(
+        description="load dumped avro files into spanner")
+    parser.add_argument(
+        '--instance_id', default="spanner-test",
+        help="Spanner instance name")
+    parser.add_argument(
+        '--database_id',  default="sync_schema3",
+        help="Spanner database name")
+    parser.add_argument(
+        '--input', default="output_*.avso",
+        help="Glob of the avro files to load")
+    parser.add_argument(
+        '--workers', type=int, default=4,
+        help="Number of files to load at once")
+    parser.add_argument(
+        '--max_mutations', type=int, default=MAX_MUTATIONS,
+        help="Spanner's per commit mutation limit")
+    parser.add_argument(
+        '--max_commit_bytes', type=int, default=MAX_COMMIT_BYTES,
+        help="Spanner's per commit size limit")
+    return parser.parse_args()
+
+
+def conf_spanner(args):
+    spanner_client = spanner.Client()
+    instance = spanner_client.instance(args.instance_id)
+    database = instance.database(args.database_id)
+    return database
+
+
+def init_worker(args):
+    global database
+    database = conf_spanner(args)
+
+
+def to_datetime(value):
+    """a datetime from seconds, milliseconds or microseconds since the
+    epoch, telling them apart by size"""
+    if value > 10 ** 14:
+        return datetime.utcfromtimestamp(value / 1000000.0)
+    if value > 10 ** 11:
+        return datetime.utcfromtimestamp(value / 1000.0)
+    return datetime.utcfromtimestamp(value)
+
+
+def bso_rows(records):
+    """yield the (row, mutations, commit bytes) of each bso record.
+
+    The first row of each user collection is also charged for its
+    user_collections row.
+
+    """
+    last = None
+    for record in records:
+        row = record[:MODIFIED] + (
+            to_datetime(record[MODIFIED]), to_datetime(record[EXPIRY]))
+        key = len(row[0]) + len(row[1]) + INT64_SIZE + len(row[3])
+        # key, sortindex, modified & expiry, payload, and the index entries
+        # (the key plus the indexed timestamp).
+        size = (key + 3 * INT64_SIZE + len(row[5]) +
+                BSO_INDEXES * (key + INT64_SIZE))
+        mutations = len(BSO_COLUMNS) + BSO_INDEXES
+        if row[:3] != last:
+            last = row[:3]
+            size += len(row[0]) + len(row[1]) + 2 * INT64_SIZE
+            mutations += len(UC_COLUMNS)
+        yield (row, mutations, size)
+
+
+class UserCollections:
+    """Most recent modified time of each user collection.
+
+    bsos come in primary key order, so only the latest collection can
+    still have more rows (in the next commit).
+    """
+    def __init__(self):
+        self.key = None
+        self.modified = None
+
+    def seen(self, row):
+        if row[:3] != self.key:
+            self.key = row[:3]
+            self.modified = row[MODIFIED]
+        elif row[MODIFIED] > self.modified:
+            self.modified = row[MODIFIED]
+
+    def rows(self, bsos):
+        """the user_collections rows for a commit of bsos"""
+        modified = {}
+        for row in bsos:
+            self.seen(row)
+            modified[self.key] = self.modified
+        return [key + (mod,) for (key, mod) in modified.items()]
+
+
+def pack(rows, max_mutations, max_bytes):
+    """yield lists of rows that each fit in a single commit"""
+    max_mutations = int(max_mutations * COMMIT_HEADROOM)
+    max_bytes = int(max_bytes * COMMIT_HEADROOM)
+    batch = []
+    mutations = 0
+    size = 0
+    for (row, row_mutations, row_size) in rows:
+        if batch and (mutations + row_mutations > max_mutations or
+                      size + row_size > max_bytes):
+            yield batch
+            batch = []
+            mutations = 0
+            size = 0
+        batch.append(row)
+        mutations += row_mutations
+        size += row_size
+    if batch:
+        yield batch
+
+
+def marker_name(path):
+    return "{}.loaded".format(path)
+
+
+def read_marker(path):
+    """(rows committed, finished) for a file"""
+    try:
+        with open(marker_name(path)) as marker:
+            progress = json.load(marker)
+        return (progress["rows"], progress["done"])
+    except (IOError, ValueError):
+        return (0, False)
+
+
+def write_marker(path, rows, done=False):
+    tmp = "{}.{}".format(marker_name(path), os.getpid())
+    with open(tmp, "w") as marker:
+        json.dump({"rows": rows, "done": done}, marker)
+    os.replace(tmp, marker_name(path))
+
+
+def is_user_collections(path):
+    return os.path.basename(path).rsplit(".", 1)[0].endswith(
+        "_user_collections")
+
+
+def load_file(path, args):
+    """load the unloaded rows of a file, returns how many were loaded"""
+    (committed, done) = read_marker(path)
+    if done:
+        return 0
+    start = time.time()
+    loaded = 0
+    user_collections = UserCollections()
+    with open(path, "rb") as avro_file:
+        rows = bso_rows(AvroReader(avro_file, columns=BSO_COLUMNS))
+        for skipped in range(committed):
+            user_collections.seen(next(rows)[0])
+        for batch in pack(rows, args.max_mutations, args.max_commit_bytes):
+            with database.batch() as spanner_batch:
+                spanner_batch.insert_or_update(
+                    table="user_collections", columns=UC_COLUMNS,
+                    values=user_collections.rows(batch))
+                spanner_batch.insert_or_update(
+                    table="bsos", columns=BSO_COLUMNS, values=batch)
+            loaded += len(batch)
+            write_marker(path, committed + loaded)
+    write_marker(path, committed + loaded, done=True)
+    seconds = time.time() - start
+    print("Loaded {} rows from {} in {} seconds ({} rows/s)".format(
+        loaded, path, round(seconds, 2),
+        int(loaded / max(seconds, 0.001))))
+    return loaded
+
+
+def load_files(pool, paths, args):
+    """load files in parallel, returns (rows, failed files)"""
+    rows = 0
+    failed = 0
+    futures = dict(
+        (pool.submit(load_file, path, args), path) for path in paths)
+    for future in as_completed(futures):
+        try:
+            rows += future.result()
+        except Exception as ex:
+            failed += 1
+            print("Could not load {}: {}".format(futures[future], ex))
+    return (rows, failed)
+
+
+def main():
+    start = time.time()
+    args = get_args()
+    paths = sorted(
+        path for path in glob.glob(args.input)
+        if not path.endswith((".part", ".loaded", ".manifest")))
+    skipped = [path for path in paths if is_user_collections(path)]
+    if skipped:
+        print("Skipping {} user_collections files, their rows are "
+              "derived from the bsos".format(len(skipped)))
+    paths = [path for path in paths if not is_user_collections(path)]
+    print("Loading {} files".format(len(paths)))
+    with ProcessPoolExecutor(
+            max_workers=args.workers,
+            initializer=init_worker,
+            initargs=(args,)) as pool:
+        (rows, failed) = load_files(pool, paths, args)
+    if failed:
+        print("{} files failed, re-run to retry them".format(failed))
+    print("Loaded: {} rows in {} seconds".format(rows, time.time() - start))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+# Parquet writer for the dump tools.
+#
+# Writes the same rows as AvroWriter, with the same interface, to a
+# parquet file instead. The columns are typed after the record schema
+# (e.g. sync.avsc), and rows are buffered into record batches of
+# `row_group_size` rows, each written as one row group. Every column is
+# zstd compressed, and all but the `payload` column are dictionary
+# encoded, so analytics tools scanning the metadata columns (fxa_uid,
+# collection_id, modified, expiry...) never read any payload bytes.
+#
+# This needs the `pyarrow` package, which is only imported when a
+# ParquetWriter is created.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import json
+
+ROW_GROUP_SIZE = 65536
+COMPRESSION = "zstd"
+# columns of (nearly) unique values, that dictionaries don't help.
+NO_DICTIONARY = ("payload",)
+
+# avro primitive type => pyarrow type factory name
+PRIMITIVES = {
+    "null": "null",
+    "boolean": "bool_",
+    "int": "int32",
+    "long": "int64",
+    "float": "float32",
+    "double": "float64",
+    "bytes": "binary",
+    "string": "string",
+}
+
+
+def _arrow_field(pa, name, avro_type):
+    if isinstance(avro_type, dict):
+        avro_type = avro_type.get("type")
+    nullable = False
+    if isinstance(avro_type, list) and len(avro_type) == 2 and \
+            "null" in avro_type:
+        nullable = True
+        avro_type = avro_type[1 - avro_type.index("null")]
+    if not isinstance(avro_type, str) or avro_type not in PRIMITIVES:
+        raise ValueError("Unsupported type for {}: {}".format(
+            name, avro_type))
+    return pa.field(
+        name, getattr(pa, PRIMITIVES[avro_type])(), nullable=nullable)
+
+
+def arrow_schema(schema):
+    """the pyarrow schema for an avro record schema"""
+    import pyarrow as pa
+    if schema.get("type") != "record":
+        raise ValueError("Only record schemas are supported")
+    return pa.schema(
+        [_arrow_field(pa, field["name"], field["type"])
+         for field in schema["fields"]],
+        metadata={"avro.schema": json.dumps(schema)})
+
+
+class ParquetWriter:
+    """Writes row tuples to a parquet file.
+
+    `schema` is the avro record schema (JSON text or parsed), `columns`
+    the order of the values in each row (the schema's field order by
+    default).
+    """
+    def __init__(self, stream, schema, columns=None,
+                 compression=COMPRESSION, row_group_size=ROW_GROUP_SIZE,
+                 level=None):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        if isinstance(schema, (str, bytes)):
+            schema = json.loads(schema)
+        self.fields = [field["name"] for field in schema["fields"]]
+        self.columns = list(columns or self.fields)
+        # where each schema field is in a row
+        self.order = [self.columns.index(name) for name in self.fields]
+        self.schema = arrow_schema(schema)
+        self.array = pa.array
+        self.record_batch = pa.RecordBatch.from_arrays
+        self.stream = stream
+        self.row_group_size = row_group_size
+        self.rows = []
+        self.writer = pq.ParquetWriter(
+            stream, self.schema,
+            compression=compression,
+            compression_level=level,
+            use_dictionary=[
+                name for name in self.fields if name not in NO_DICTIONARY])
+
+    def append_row(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= self.row_group_size:
+            self.flush()
+
+    def append_rows(self, rows):
+        for row in rows:
+            self.append_row(row)
+
+    def append(self, datum):
+        """DataFileWriter style, from a dict"""
+        self.append_row(tuple(datum.get(column) for column in self.columns))
+
+    def flush(self):
+        if not self.rows:
+            return
+        values = list(zip(*self.rows))
+        arrays = [
+            self.array(values[index], type=field.type)
+            for (index, field) in zip(self.order, self.schema)]
+        self.writer.write_batch(
+            self.record_batch(arrays, schema=self.schema),
+            row_group_size=len(self.rows))
+        self.rows = []
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+        self.stream.close()